@@ -11,16 +11,30 @@ import urllib.parse
 from datetime import datetime
 from typing import Dict, Callable
 
+import aiohttp
 import requests
 from aiohttp import ClientResponse, ClientResponseError
 from requests import Request, HTTPError
 from exchangeworker import ExchangeWorker
+from priceindex import PriceIndex
 from api.dbmodels.client import Client
 import api.dbmodels.balance as balance
 
 
 class _BinanceBaseClient(ExchangeWorker):
 
+    # https://binance-docs.github.io/apidocs/spot/en/#limits
+    _RATE_LIMIT_INTERVAL = 60
+
+    # User data stream
+    _LISTEN_KEY_PATH = ''
+    _ACCOUNT_EVENTS = ()
+
+    def _get_used_weight(self, response: ClientResponse):
+        used = response.headers.get('X-MBX-USED-WEIGHT-1M') or response.headers.get('X-MBX-USED-WEIGHT')
+        if used:
+            return int(used)
+
     def _sign_request(self, method: str, path: str, headers=None, params=None, data=None, **kwargs) -> None:
         ts = int(time.time() * 1000)
         headers['X-MBX-APIKEY'] = self._api_key
@@ -57,6 +71,36 @@ class _BinanceBaseClient(ExchangeWorker):
         if response.status == 200:
             return response_json
 
+    # https://binance-docs.github.io/apidocs/futures/en/#user-data-streams
+    async def _stream(self):
+        headers = {'X-MBX-APIKEY': self._api_key}
+        response = await self._post(self._LISTEN_KEY_PATH, sign=False, headers=headers)
+        listen_key = response.get('listenKey')
+        if not listen_key:
+            logging.error(f'Could not create listen key for {self}: {response.get("msg")}')
+            return
+
+        async def keep_alive():
+            while True:
+                # Listen keys expire after 60 minutes
+                await asyncio.sleep(30 * 60)
+                await self._put(self._LISTEN_KEY_PATH, sign=False, headers=headers, params={'listenKey': listen_key})
+
+        keep_alive_task = asyncio.create_task(keep_alive())
+        try:
+            async with self._session.ws_connect(self._WS_ENDPOINT + listen_key) as ws:
+                async for message in ws:
+                    if message.type == aiohttp.WSMsgType.TEXT:
+                        event = message.json()
+                        if event.get('e') in self._ACCOUNT_EVENTS:
+                            self._on_account_update()
+                        elif event.get('e') == 'listenKeyExpired':
+                            return
+                    elif message.type == aiohttp.WSMsgType.ERROR:
+                        return
+        finally:
+            keep_alive_task.cancel()
+
 
 class _TickerCache(NamedTuple):
     ticker: dict
@@ -67,6 +111,15 @@ class BinanceFutures(_BinanceBaseClient):
     _ENDPOINT = 'https://fapi.binance.com'
     exchange = 'binance-futures'
 
+    _RATE_LIMIT_WEIGHT = 2400
+    _WEIGHTS = {
+        '/fapi/v2/account': 5
+    }
+
+    _WS_ENDPOINT = 'wss://fstream.binance.com/ws/'
+    _LISTEN_KEY_PATH = '/fapi/v1/listenKey'
+    _ACCOUNT_EVENTS = ('ACCOUNT_UPDATE',)
+
     # https://binance-docs.github.io/apidocs/futures/en/#account-information-v2-user_data
     async def _get_balance(self, time: datetime = None):
         response = await self._get('/fapi/v2/account')
@@ -91,40 +144,56 @@ class BinanceSpot(_BinanceBaseClient):
     _ENDPOINT = 'https://api.binance.com/api/v3'
     exchange = 'binance-spot'
 
+    _RATE_LIMIT_WEIGHT = 1200
+    _WEIGHTS = {
+        '/account': 10,
+        '/ticker/price': 2
+    }
+
+    _WS_ENDPOINT = 'wss://stream.binance.com:9443/ws/'
+    _LISTEN_KEY_PATH = '/userDataStream'
+    _ACCOUNT_EVENTS = ('outboundAccountPosition',)
+
+    _price_index = PriceIndex('binance-spot')
+
     # https://binance-docs.github.io/apidocs/spot/en/#account-information-user_data
     async def _get_balance(self, time: datetime):
 
-        results = await asyncio.gather(
+        response, ticker_prices = await asyncio.gather(
             self._get('/account'),
-            self._get('/ticker/price', sign=False, cache=True)
+            self._price_index.get_prices(self._fetch_prices)
         )
 
-        if isinstance(results[0], dict):
-            response = results[0]
-            tickers = results[1]
-        else:
-            response = results[1]
-            tickers = results[0]
-
         total_balance = 0
         extra_currencies: Dict[str, float] = {}
         err_msg = None
 
         if response.get('msg') is None:
             data = response['balances']
-            ticker_prices = {
-                ticker['symbol']: ticker['price'] for ticker in tickers
-            }
-            for cur_balance in data:
-                currency = cur_balance['asset']
-                amount = float(cur_balance['free']) + float(cur_balance['locked'])
-                price = 0
-                if currency == 'USDT':
-                    price = 1
-                elif amount > 0 and currency != 'LDUSDT' and currency != 'LDSRM':
-                    price = float(ticker_prices.get(f'{currency}USDT', 0))
-                total_balance += amount * price
+            if ticker_prices:
+                for cur_balance in data:
+                    currency = cur_balance['asset']
+                    amount = float(cur_balance['free']) + float(cur_balance['locked'])
+                    price = 0
+                    if currency == 'USDT':
+                        price = 1
+                    elif amount > 0 and currency != 'LDUSDT' and currency != 'LDSRM':
+                        price = ticker_prices.get(f'{currency}USDT', 0)
+                    total_balance += amount * price
+            else:
+                err_msg = 'Binance tickers are currently unavailable. Try again later.'
         else:
             err_msg = response['msg']
 
         return balance.Balance(amount=total_balance, currency='$', extra_currencies=extra_currencies, error=err_msg)
+
+    # https://binance-docs.github.io/apidocs/spot/en/#symbol-price-ticker
+    async def _fetch_prices(self):
+        tickers = await self._get('/ticker/price', sign=False)
+        if isinstance(tickers, dict):
+            # Error message
+            return None
+        # Only USDT pairs are used for pricing, which keeps the index at a fraction of the ~2000 symbols
+        return {
+            ticker['symbol']: float(ticker['price']) for ticker in tickers if ticker['symbol'].endswith('USDT')
+        }
@@ -8,12 +8,15 @@ import time
 import logging
 from datetime import datetime
 from exchangeworker import ExchangeWorker
+from priceindex import PriceIndex
 
 
 class BitmexClient(ExchangeWorker):
     exchange = 'bitmex'
     _ENDPOINT = 'https://www.bitmex.com'
 
+    _price_index = PriceIndex('bitmex')
+
     # https://www.bitmex.com/api/explorer/#!/User/User_getWallet
     async def _get_balance(self, time: datetime):
         # Could do something like that for displaying a trade history
@@ -32,7 +35,12 @@ class BitmexClient(ExchangeWorker):
         total_balance = 0
         extra_currencies = {}
         err_msg = None
-        if 'error' not in response:
+        prices = await self._price_index.get_prices(self._fetch_prices) if 'error' not in response else {}
+        if 'error' in response:
+            err_msg = response['error']
+        elif not prices:
+            err_msg = 'Bitmex prices are currently unavailable. Try again later.'
+        else:
             for currency in response:
                 symbol = currency['currency'].upper()
                 amount = currency['marginBalance']
@@ -42,16 +50,8 @@ class BitmexClient(ExchangeWorker):
                 if symbol == 'USDT':
                     price = 1
                 elif amount > 0:
-                    response_price = await self._get(
-                        '/api/v1/trade',
-                        params={
-                            'symbol': symbol.upper(),
-                            'count': 1,
-                            'reverse': 'True'
-                        }
-                    )
-                    if len(response_price) > 0:
-                        price = response_price[0]['price']
+                    # Gwei balances are priced by ETH
+                    price = prices.get('ETH' if symbol == 'GWEI' else symbol, 0)
                 if 'XBT' in symbol:
                     # XBT amount is given in Sats (100 Million Sats = 1BTC)
                     amount *= 10**-8
@@ -62,14 +62,25 @@ class BitmexClient(ExchangeWorker):
                     amount *= 10**-9
                 extra_currencies[symbol] = amount
                 total_balance += amount * price
-        else:
-            err_msg = response['error']
 
         return Balance(amount=total_balance,
                        currency='$',
                        extra_currencies=extra_currencies,
                        error=err_msg)
 
+    # https://www.bitmex.com/api/explorer/#!/Instrument/Instrument_getActive
+    async def _fetch_prices(self):
+        response = await self._get('/api/v1/instrument/active', sign=False)
+        if 'error' in response:
+            return None
+        prices = {}
+        for instrument in response:
+            # Perpetual swaps quoted in USD(T) are used as the reference price of their underlying
+            if instrument.get('typ') == 'FFWCSX' and instrument.get('quoteCurrency') in ('USD', 'USDT') \
+                    and instrument.get('lastPrice'):
+                prices.setdefault(instrument['underlying'], instrument['lastPrice'])
+        return prices
+
     # https://www.bitmex.com/app/apiKeysUsage
     def _sign_request(self, method: str, path: str, headers=None, params=None, data=None, **kwargs):
         ts = int(time.time() * 1000)
@@ -7,9 +7,11 @@ import json
 import sys
 from datetime import datetime
 
+import aiohttp
 from aiohttp import ClientResponse, ClientResponseError
 
 from exchangeworker import ExchangeWorker
+from priceindex import PriceIndex
 from api.dbmodels.balance import Balance
 from requests import Request, Response, Session, HTTPError
 from typing import List, Tuple, Dict
@@ -19,35 +21,32 @@ class BybitClient(ExchangeWorker):
     exchange = 'bybit'
     _ENDPOINT = 'https://api.bybit.com'
 
+    # https://bybit-exchange.github.io/docs/inverse/#t-ratelimits
+    _RATE_LIMIT_WEIGHT = 50
+    _RATE_LIMIT_INTERVAL = 1
+
+    _WS_ENDPOINT = 'wss://stream.bybit.com/realtime'
+
+    _price_index = PriceIndex('bybit')
+
     amount = float
     type = str
 
     # https://bybit-exchange.github.io/docs/inverse/?console#t-balance
     async def _get_balance(self, time: datetime):
 
-        results = await asyncio.gather(
+        balance, ticker_prices = await asyncio.gather(
             self._get('/v2/private/wallet/balance'),
-            self._get('/v2/public/tickers', sign=False, cache=True)
+            self._price_index.get_prices(self._fetch_prices)
         )
 
-        if isinstance(results[0], Dict):
-            balance = results[0]
-            tickers = results[1]
-        else:
-            balance = results[1]
-            tickers = results[0]
-
         total_balance = 0.0
         extra_currencies: Dict[str, float] = {}
         err_msg = None
 
         if balance['ret_code'] == 0:
             data = balance['result']
-            if tickers['ret_code'] == 0:
-                ticker_data = tickers['result']
-                ticker_prices = {
-                    ticker['symbol']: ticker['last_price'] for ticker in ticker_data
-                }
+            if ticker_prices:
                 for currency in data:
                     amount = float(data[currency]['equity'])
                     price = 0.0
@@ -59,14 +58,25 @@ class BybitClient(ExchangeWorker):
                         if not price:
                             logging.info(f'Bybit Bug: ticker prices do not contain info about {currency}:\n{ticker_prices}')
                             continue
-                    total_balance += amount * float(price)
+                    total_balance += amount * price
             else:
-                err_msg = tickers['ret_msg']
+                err_msg = 'Bybit tickers are currently unavailable. Try again later.'
         else:
             err_msg = balance['ret_msg']
 
         return Balance(amount=total_balance, currency='$', extra_currencies=extra_currencies, error=err_msg)
 
+    # https://bybit-exchange.github.io/docs/inverse/#t-latestsymbolinfo
+    async def _fetch_prices(self):
+        tickers = await self._get('/v2/public/tickers', sign=False)
+        if tickers['ret_code'] != 0:
+            logging.error(f'Could not fetch bybit tickers: {tickers["ret_msg"]}')
+            return None
+        return {
+            ticker['symbol']: float(ticker['last_price']) for ticker in tickers['result']
+            if ticker['symbol'].endswith(('USD', 'USDT')) and ticker['last_price']
+        }
+
     # https://bybit-exchange.github.io/docs/inverse/?console#t-authentication
     def _sign_request(self, method: str, path: str, headers=None, params=None, data=None, **kwargs):
         ts = int(time.time() * 1000)
@@ -107,3 +117,33 @@ class BybitClient(ExchangeWorker):
         # OK
         if response.status == 200:
             return response_json
+
+    # https://bybit-exchange.github.io/docs/inverse/#t-websocketauthentication
+    async def _stream(self):
+        async with self._session.ws_connect(self._WS_ENDPOINT) as ws:
+            expires = int((time.time() + 10) * 1000)
+            signature = hmac.new(
+                self._api_secret.encode('utf-8'), f'GET/realtime{expires}'.encode('utf-8'), 'sha256'
+            ).hexdigest()
+            await ws.send_json({'op': 'auth', 'args': [self._api_key, expires, signature]})
+            await ws.send_json({'op': 'subscribe', 'args': ['position', 'execution']})
+
+            async def ping():
+                while True:
+                    await asyncio.sleep(20)
+                    await ws.send_json({'op': 'ping'})
+
+            ping_task = asyncio.create_task(ping())
+            try:
+                async for message in ws:
+                    if message.type == aiohttp.WSMsgType.TEXT:
+                        data = message.json()
+                        if data.get('topic') in ('position', 'execution'):
+                            self._on_account_update()
+                        elif data.get('request', {}).get('op') == 'auth' and not data.get('success'):
+                            logging.error(f'Stream authentication of {self} failed: {data.get("ret_msg")}')
+                            return
+                    elif message.type == aiohttp.WSMsgType.ERROR:
+                        return
+            finally:
+                ping_task.cancel()
@@ -15,6 +15,10 @@ class FtxClient(ExchangeWorker):
     exchange = 'ftx'
     _ENDPOINT = 'https://ftx.com'
 
+    # https://docs.ftx.com/#rate-limits
+    _RATE_LIMIT_WEIGHT = 30
+    _RATE_LIMIT_INTERVAL = 1
+
     # https://docs.ftx.com/#account
     async def _get_balance(self, time: datetime):
 
@@ -16,6 +16,10 @@ class KuCoinClient(ExchangeWorker):
     exchange = 'kucoin'
     _ENDPOINT = 'https://api-futures.kucoin.com'
 
+    # https://docs.kucoin.com/futures/#request-rate-limit
+    _RATE_LIMIT_WEIGHT = 2000
+    _RATE_LIMIT_INTERVAL = 30
+
     required_extra_args = [
         'passphrase'
     ]
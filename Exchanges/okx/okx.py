@@ -1,64 +1,133 @@
-import sys
-import json
+import asyncio
+import base64
 import hmac
-from requests import Request, Response, Session, HTTPError
+import aiohttp
+from aiohttp import ClientResponse, ClientResponseError
 import api.dbmodels.balance as balance
-import urllib.parse
 import time
 import logging
-import ccxt.async_support as ccxt
 from datetime import datetime
 from exchangeworker import ExchangeWorker
 
 
 class OkxClient(ExchangeWorker):
-    ENDPOINT = 'https://www.bitmex.com/api/v1/'
+    _ENDPOINT = 'https://www.okx.com'
 
     exchange = 'okx'
     required_extra_args = ['passphrase']
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.ccxt_client = ccxt.okex({
-            'apiKey': self._api_key,
-            'secret': self._api_secret,
-            'password': self._extra_kwargs['passphrase']
-        })
+    # https://www.okx.com/docs-v5/en/#rest-api-account-get-balance (10 requests per 2 seconds)
+    _RATE_LIMIT_WEIGHT = 10
+    _RATE_LIMIT_INTERVAL = 2
 
-    async def _get_balance(self, time: datetime):
+    _WS_ENDPOINT = 'wss://ws.okx.com:8443/ws/v5/private'
 
-        # Could do something like that for displaying a trade history
-        # request = Request(
-        #     'GET',
-        #     self.ENDPOINT + 'execution/tradeHistory',
-        #     params={
-        #         'startTime': str(datetime.now().replace(hour=0, minute=0, second=0, microsecond=0))
-        #     }
-        # )
-        # res = self._request(request)
+    # https://www.okx.com/docs-v5/en/#rest-api-account-get-balance
+    async def _get_balance(self, time: datetime):
+        response = await self._get('/api/v5/account/balance')
 
+        total = 0
+        extra_currencies = {}
         error = None
-        total_balance = None
+        if response['code'] == '0':
+            for account in response['data']:
+                # Equity is already given in USD, so there is no need to download any tickers
+                total += float(account['totalEq'] or 0)
+                for detail in account.get('details', []):
+                    amount = float(detail['eq'] or 0)
+                    if detail['ccy'] != 'USDT' and amount > 0:
+                        extra_currencies[detail['ccy']] = amount
+        else:
+            error = response['msg']
+
+        return balance.Balance(amount=total, currency='$', error=error, extra_currencies=extra_currencies)
 
+    def _sign(self, payload: str) -> str:
+        return base64.b64encode(
+            hmac.new(self._api_secret.encode('utf-8'), payload.encode('utf-8'), 'sha256').digest()
+        ).decode()
+
+    # https://www.okx.com/docs-v5/en/#rest-api-authentication-signature
+    def _sign_request(self, method: str, path: str, headers=None, params=None, data=None, **kwargs):
+        ts = datetime.utcnow().isoformat(timespec='milliseconds') + 'Z'
+        signature_payload = f'{ts}{method}{path}{self._query_string(params)}'
+        if data is not None:
+            signature_payload += data
+        headers['OK-ACCESS-KEY'] = self._api_key
+        headers['OK-ACCESS-SIGN'] = self._sign(signature_payload)
+        headers['OK-ACCESS-TIMESTAMP'] = ts
+        headers['OK-ACCESS-PASSPHRASE'] = self._extra_kwargs['passphrase']
+
+    async def _process_response(self, response: ClientResponse) -> dict:
+        response_json = await response.json()
         try:
-            total_balance = await self.ccxt_client.fetch_total_balance()
-            tickers = await self.ccxt_client.fetch_tickers()
-        except ccxt.errors.AuthenticationError:
-            error = 'Unauthorized. Is your api key valid? Did you specify the right subaccount? You might want to check your API access.'
-        except ccxt.errors.ExchangeError:
-            error = 'This is a problem with the OKEX servers, try again later.'
-        except ccxt.errors.BaseError as e:
-            error = str(e)
+            response.raise_for_status()
+        except ClientResponseError as e:
+            logging.error(f'{e}\n{response_json}')
 
-        total = 0
-        if error is None:
-            for currency in total_balance:
-                amount = total_balance[currency]
-                price = 0
-                if currency == 'USDT':
-                    price = 1
-                elif amount > 0:
-                    price = tickers.get(f'{currency}/USDT')['last']
-                total += amount * price
-
-        return balance.Balance(amount=total, currency='$', error=error, extra_currencies={})
+            error = ''
+            if response.status == 400:
+                error = "400 Bad Request. This is probably a bug in the bot, please contact dev"
+            elif response.status == 401:
+                error = f"401 Unauthorized ({response_json.get('msg')}). Is your api key valid? Did you specify the right subaccount? You might want to check your API access"
+            elif response.status == 403:
+                error = f"403 Access Denied ({response_json.get('msg')}). Is your api key valid? Did you specify the right subaccount? You might want to check your API access"
+            elif response.status == 404:
+                error = "404 Not Found. This is probably a bug in the bot, please contact dev"
+            elif response.status == 429:
+                error = "429 Rate Limit violated. Try again later"
+            elif 500 <= response.status < 600:
+                error = f"{response.status} Problem or Maintenance on {self.exchange} servers."
+
+            # Return standard HTTP error message if status code isnt specified
+            if error == '':
+                error = e.args[0]
+
+            return {'code': str(response.status), 'msg': error, 'data': []}
+
+        # OK
+        if response.status == 200:
+            return response_json
+
+    # https://www.okx.com/docs-v5/en/#websocket-api-private-channel-account-channel
+    async def _stream(self):
+        async with self._session.ws_connect(self._WS_ENDPOINT) as ws:
+            ts = str(time.time())
+            await ws.send_json({
+                'op': 'login',
+                'args': [{
+                    'apiKey': self._api_key,
+                    'passphrase': self._extra_kwargs['passphrase'],
+                    'timestamp': ts,
+                    'sign': self._sign(f'{ts}GET/users/self/verify')
+                }]
+            })
+
+            async def ping():
+                while True:
+                    await asyncio.sleep(20)
+                    await ws.send_str('ping')
+
+            ping_task = asyncio.create_task(ping())
+            try:
+                async for message in ws:
+                    if message.type == aiohttp.WSMsgType.TEXT:
+                        if message.data == 'pong':
+                            continue
+                        data = message.json()
+                        if data.get('event') == 'login':
+                            await ws.send_json({'op': 'subscribe', 'args': [{'channel': 'account'}]})
+                        elif data.get('event') == 'error':
+                            logging.error(f'Stream error for {self}: {data.get("msg")}')
+                            return
+                        elif data.get('arg', {}).get('channel') == 'account':
+                            # The account channel pushes the total equity directly
+                            for account in data.get('data', []):
+                                self._set_live_balance(
+                                    balance.Balance(amount=float(account['totalEq']), currency='$', error=None,
+                                                    extra_currencies={}, time=datetime.now())
+                                )
+                    elif message.type == aiohttp.WSMsgType.ERROR:
+                        return
+            finally:
+                ping_task.cancel()
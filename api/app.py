@@ -5,7 +5,9 @@ from api.dbmodels.archive import Archive
 from api.dbmodels.client import Client
 from api.dbmodels.discorduser import DiscordUser
 from api.dbmodels.balance import Balance
+from api.dbmodels.balancerollup import BalanceRollup
 from api.dbmodels.event import Event
+from api.dbmodels.guildmember import GuildMember
 
 db.init_app(app)
 migrate.init_app(app, db)
@@ -1,7 +1,10 @@
 from flask import Flask
 from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
 import dotenv
+import logging
 import os
 dotenv.load_dotenv()
 
@@ -12,3 +15,26 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 db = SQLAlchemy(app=app, session_options={'autoflush': False})
 migrate = Migrate()
+
+# Async drivers for the configured database
+_ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'postgresql+psycopg2': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite'
+}
+
+
+def _get_async_uri(uri: str) -> str:
+    scheme, rest = uri.split('://', 1)
+    return f'{_ASYNC_DRIVERS.get(scheme, scheme)}://{rest}'
+
+
+# Used by the fetch cycles and the balance retention so their database latency doesn't block the bot.
+# Commands and the reads in dbutils still go through the Flask-SQLAlchemy session.
+# Objects loaded through it are detached from the Flask-SQLAlchemy session and must not lazy load relationships.
+async_engine = create_async_engine(_get_async_uri(app.config['SQLALCHEMY_DATABASE_URI']))
+async_session = sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False, autoflush=False)
+
+if async_engine.dialect.name != 'postgresql':
+    # Both engines write to the same database, SQLite locks the whole file for every write
+    logging.warning(f'Only PostgreSQL is supported, commands may fail with "database is locked" on {async_engine.dialect.name}')
@@ -1,17 +1,34 @@
 from datetime import datetime
+from typing import Iterable, Iterator
+
+from sqlalchemy.dialects.postgresql import JSONB
 
 from api.database import db
 import config
 
 
 class Balance(db.Model):
+    __table_args__ = (
+        # History, range and latest lookups of a client. Covering the amount allows index only scans on PostgreSQL
+        db.Index('ix_balance_client_id_time', 'client_id', 'time', postgresql_include=['amount']),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     client_id = db.Column(db.Integer, db.ForeignKey('client.id', ondelete="CASCADE"), nullable=True)
     time = db.Column(db.DateTime, nullable=False)
+    # Set if the row represents a run of unchanged balances (time being the first, last_time the last fetch)
+    last_time = db.Column(db.DateTime, nullable=True)
     amount = db.Column(db.Float, nullable=False)
     currency = db.Column(db.String, nullable=False)
     error = db.Column(db.String, nullable=True)
-    extra_currencies = db.Column(db.PickleType, nullable=True)
+    # Amounts of the single currencies, stored as JSON so that single currencies can be read inside the database
+    extra_currencies = db.Column('currencies', db.JSON().with_variant(JSONB(), 'postgresql'), nullable=True)
+    # Pickled extra currencies of balances which haven't been migrated yet (see migrate.py --currencies)
+    legacy_extra_currencies = db.deferred(db.Column('extra_currencies', db.PickleType, nullable=True))
+
+    @property
+    def last_seen(self) -> datetime:
+        return self.last_time or self.time
 
     def to_json(self, currency=False):
         json = {
@@ -47,3 +64,22 @@ def balance_from_json(data: dict, time: datetime):
         extra_currencies=data.get('extra_currencies', None),
         time=time
     )
+
+
+def expand_runs(balances: Iterable[Balance]) -> Iterator[Balance]:
+    """
+    Expands run length encoded balances back into points, so that a run is represented by
+    its first and last fetch. The points for the end of runs are transient and not attached to the session.
+    :param balances: Balances ordered by time
+    """
+    for balance in balances:
+        yield balance
+        if balance.last_time and balance.last_time > balance.time:
+            yield Balance(
+                client_id=balance.client_id,
+                time=balance.last_time,
+                amount=balance.amount,
+                currency=balance.currency,
+                error=balance.error,
+                extra_currencies=balance.extra_currencies
+            )
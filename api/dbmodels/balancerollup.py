@@ -0,0 +1,30 @@
+from datetime import datetime, timedelta
+
+from api.database import db
+
+# Resolution -> bucket size
+RESOLUTIONS = {
+    'hour': timedelta(hours=1),
+    'day': timedelta(days=1)
+}
+
+
+class BalanceRollup(db.Model):
+    """
+    Open, high, low and close of the $ balance of a client per hour or day, updated after each fetch cycle.
+    """
+    __tablename__ = 'balancerollup'
+
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id', ondelete="CASCADE"), primary_key=True)
+    resolution = db.Column(db.String, primary_key=True)
+    bucket = db.Column(db.DateTime, primary_key=True)
+    open = db.Column(db.Float, nullable=False)
+    high = db.Column(db.Float, nullable=False)
+    low = db.Column(db.Float, nullable=False)
+    close = db.Column(db.Float, nullable=False)
+
+
+def get_bucket(time: datetime, resolution: str) -> datetime:
+    if resolution == 'day':
+        return time.replace(hour=0, minute=0, second=0, microsecond=0)
+    return time.replace(minute=0, second=0, microsecond=0)
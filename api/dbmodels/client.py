@@ -26,12 +26,13 @@ class Client(db.Model):
 
     # Identification
     id = db.Column(db.Integer, primary_key=True)
-    discord_user_id = db.Column(db.Integer, db.ForeignKey('discorduser.id', ondelete="CASCADE"), nullable=True)
+    discord_user_id = db.Column(db.Integer, db.ForeignKey('discorduser.id', ondelete="CASCADE"), nullable=True, index=True)
 
     # User Information
     api_key = db.Column(db.String(), nullable=False)
     #api_secret = db.Column(db.String(), nullable=False)
-    api_secret = db.Column(StringEncryptedType(db.String(), _key.encode('utf-8'), FernetEngine), nullable=False)
+    # Deferred so that only building a worker pays for the decryption, not every query loading clients
+    api_secret = db.deferred(db.Column(StringEncryptedType(db.String(), _key.encode('utf-8'), FernetEngine), nullable=False))
     exchange = db.Column(db.String, nullable=False)
     subaccount = db.Column(db.String, nullable=True)
     extra_kwargs = db.Column(db.PickleType, nullable=True)
@@ -44,12 +45,9 @@ class Client(db.Model):
 
     required_extra_args: List[str] = []
 
-    @hybrid_property
+    @property
     def latest(self):
-        try:
-            return self.history[len(self.history) - 1]
-        except ValueError:
-            return None
+        return balance.Balance.query.filter_by(client_id=self.id).order_by(balance.Balance.time.desc()).first()
 
     @hybrid_property
     def is_global(self):
@@ -59,12 +57,12 @@ class Client(db.Model):
     def is_active(self):
         return not all(not event.is_active for event in self.events)
 
-    @hybrid_property
+    @property
     def initial(self):
-        try:
-            return self.history[0]
-        except (ValueError, IndexError):
-            return balance.Balance(amount=config.REGISTRATION_MINIMUM, currency='$', error=None)
+        initial = balance.Balance.query.filter_by(client_id=self.id).order_by(balance.Balance.time).first()
+        if initial:
+            return initial
+        return balance.Balance(amount=config.REGISTRATION_MINIMUM, currency='$', error=None)
 
     def get_event_string(self, is_global=False):
         events = ''
@@ -90,7 +88,8 @@ class Client(db.Model):
         for extra in self.extra_kwargs:
             embed_add_value(embed, name=extra, value=self.extra_kwargs[extra])
 
-        if len(self.history) > 0:
-            embed_add_value(embed, name='Initial Balance', value=self.history[0].to_string())
+        initial = balance.Balance.query.filter_by(client_id=self.id).order_by(balance.Balance.time).first()
+        if initial:
+            embed_add_value(embed, name='Initial Balance', value=initial.to_string())
 
         return embed
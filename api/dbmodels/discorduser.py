@@ -10,7 +10,7 @@ from api.dbmodels.client import Client
 class DiscordUser(db.Model):
     __tablename__ = 'discorduser'
     id = db.Column(db.Integer(), primary_key=True)
-    user_id = db.Column(db.BigInteger(), nullable=False)
+    user_id = db.Column(db.BigInteger(), nullable=False, index=True)
     name = db.Column(db.String(), nullable=True)
 
     global_client_id = db.Column(db.Integer(), db.ForeignKey('client.id', ondelete="SET NULL"), nullable=True)
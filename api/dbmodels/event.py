@@ -17,7 +17,9 @@ if TYPE_CHECKING:
 
 association = db.Table('association',
                        db.Column('event_id', db.Integer, db.ForeignKey('event.id', ondelete="CASCADE"), primary_key=True),
-                       db.Column('client_id', db.Integer, db.ForeignKey('client.id', ondelete="CASCADE"), primary_key=True)
+                       db.Column('client_id', db.Integer, db.ForeignKey('client.id', ondelete="CASCADE"), primary_key=True),
+                       # The primary key only serves lookups by event
+                       db.Index('ix_association_client_id', 'client_id')
                        )
 
 
@@ -0,0 +1,12 @@
+from api.database import db
+
+
+class GuildMember(db.Model):
+    """
+    Membership of a registered user in a guild the bot is part of, kept up to date from the member join/leave events.
+    The primary key starts with the guild so that the members of a guild are a single index range.
+    """
+    __tablename__ = 'guildmember'
+
+    guild_id = db.Column(db.BigInteger, primary_key=True)
+    discord_user_id = db.Column(db.Integer, db.ForeignKey('discorduser.id', ondelete="CASCADE"), primary_key=True)
@@ -1,11 +1,28 @@
 from __future__ import annotations
-from datetime import datetime
+import csv
+import io
+import json
+from datetime import datetime, timedelta
 
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from api.database import db
+from api.dbmodels.balance import Balance, expand_runs
+from api.dbmodels.balancerollup import BalanceRollup, RESOLUTIONS, get_bucket
 from api.dbmodels.client import Client
 from api.dbmodels.discorduser import DiscordUser
+from api.dbmodels.guildmember import GuildMember
 import api.dbmodels.event as db_event
-from typing import Optional
+from typing import Optional, List, Dict, Any, Iterable, Tuple, Set
 from errors import UserInputError
+from cache import TTLCache
+from models.eventwindow import EventWindow
+from config import CURRENCY_ALIASES
+
+# Time windows of the running and upcoming events per guild, every guild command resolves its event through them
+_event_cache = TTLCache('events', maxsize=1024, ttl=60)
+# Maximum number of values in a single IN filter
+_IN_CHUNK_SIZE = 1000
 
 
 def get_client(user_id: int,
@@ -17,19 +34,19 @@ def get_client(user_id: int,
         if guild_id:
 
             if registration:
-                event = get_event(guild_id, state='registration', throw_exceptions=False)
-                if event:
-                    for client in event.registrations:
-                        if client.discorduser.user_id == user_id:
-                            return client
-
-            event = get_event(guild_id, state='active', throw_exceptions=False)
-            if event:
-                for client in event.registrations:
-                    if client.discorduser.user_id == user_id:
+                event_id = get_event_id(guild_id, state='registration')
+                if event_id:
+                    client = get_registration(event_id, user.id)
+                    if client:
                         return client
-            if event and throw_exceptions:
-                raise UserInputError("User {name} is not registered for this event", user_id)
+
+            event_id = get_event_id(guild_id, state='active')
+            if event_id:
+                client = get_registration(event_id, user.id)
+                if client:
+                    return client
+                if throw_exceptions:
+                    raise UserInputError("User {name} is not registered for this event", user_id)
         if user.global_client:
             return user.global_client
         elif throw_exceptions:
@@ -38,6 +55,56 @@ def get_client(user_id: int,
         raise UserInputError("User {name} is not registered", user_id)
 
 
+def get_registration(event_id: int, discord_user_id: int) -> Optional[Client]:
+    """
+    Finds the client a user registered for an event with.
+    :param discord_user_id: id of the DiscordUser row (not the discord id)
+    """
+    return Client.query.join(
+        db_event.association, db_event.association.c.client_id == Client.id
+    ).filter(
+        db_event.association.c.event_id == event_id,
+        Client.discord_user_id == discord_user_id
+    ).first()
+
+
+def get_event_id(guild_id: int, state: str = 'active') -> Optional[int]:
+    """
+    Resolves the id of the guild's event in the given state ('active' or 'registration') from the event cache.
+    """
+    now = datetime.now()
+    for window in _get_event_windows(guild_id):
+        if state == 'active' and window.start <= now <= window.end:
+            return window.id
+        if state == 'registration' and window.registration_start <= now <= window.registration_end:
+            return window.id
+
+
+def invalidate_events(guild_id: int):
+    """
+    Has to be called once events of the guild were added or changed.
+    """
+    _event_cache.invalidate('windows', guild_id)
+
+
+def _get_event_windows(guild_id: int) -> List[EventWindow]:
+    windows = _event_cache.get('windows', guild_id)
+    if windows is None:
+        now = datetime.now()
+        Event = db_event.Event
+        # States are evaluated on lookup, so only new or edited events invalidate the cached windows
+        windows = [
+            EventWindow(*row) for row in db.session.query(
+                Event.id, Event.registration_start, Event.registration_end, Event.start, Event.end
+            ).filter(
+                Event.guild_id == guild_id,
+                db.or_(Event.end >= now, Event.registration_end >= now)
+            ).order_by(Event.id)
+        ]
+        _event_cache.set('windows', guild_id, windows)
+    return windows
+
+
 def get_event(guild_id: int, channel_id: int = None, state: str = 'active',
               throw_exceptions=True) -> Optional[db_event.Event]:
 
@@ -52,17 +119,14 @@ def get_event(guild_id: int, channel_id: int = None, state: str = 'active',
     filters = [db_event.Event.guild_id == guild_id]
     if state == 'archived':
         filters.append(db_event.Event.end < now)
-    elif state == 'active':
-        filters.append(db_event.Event.start <= now)
-        filters.append(now <= db_event.Event.end)
-    elif state == 'registration':
-        filters.append(db_event.Event.registration_start <= now)
-        filters.append(now <= db_event.Event.registration_end)
 
     if state == 'archived':
         events = db_event.Event.query.filter(*filters).all()
         events.sort(key=lambda x: x.end, reverse=True)
         event = events[0]
+    elif state in ('active', 'registration'):
+        event_id = get_event_id(guild_id, state)
+        event = db_event.Event.query.get(event_id) if event_id else None
     else:
         event = db_event.Event.query.filter(*filters).first()
 
@@ -93,6 +157,70 @@ def get_user(user_id: int, throw_exceptions=True) -> Optional[DiscordUser]:
     return result
 
 
+def get_guild_clients(guild_id: int) -> List[Client]:
+    """
+    Loads the global clients of all registered users which are members of the given guild.
+    """
+    return Client.query.join(
+        DiscordUser, DiscordUser.global_client_id == Client.id
+    ).join(
+        GuildMember, GuildMember.discord_user_id == DiscordUser.id
+    ).filter(
+        GuildMember.guild_id == guild_id
+    ).all()
+
+
+def add_guild_member(guild_id: int, user_id: int):
+    """
+    Records that the user is a member of the guild, users which aren't registered are ignored.
+    :param user_id: discord id of the member
+    """
+    user = DiscordUser.query.filter_by(user_id=user_id).first()
+    if user:
+        db.session.merge(GuildMember(guild_id=guild_id, discord_user_id=user.id))
+
+
+def remove_guild_member(guild_id: int, user_id: int):
+    """
+    :param user_id: discord id of the member
+    """
+    GuildMember.query.filter(
+        GuildMember.guild_id == guild_id,
+        GuildMember.discord_user_id.in_(db.select(DiscordUser.id).filter(DiscordUser.user_id == user_id))
+    ).delete(synchronize_session=False)
+
+
+def sync_guild_members(guild_id: int, member_ids: Iterable[int]):
+    """
+    Replaces the stored members of a guild with the registered users among the given members.
+    :param member_ids: discord ids of all members of the guild
+    """
+    member_ids = list(set(member_ids))
+    members = set()
+    # Chunked to stay below the parameter limits of the database drivers on large guilds
+    for start in range(0, len(member_ids), _IN_CHUNK_SIZE):
+        members.update(
+            discord_user_id for discord_user_id, in db.session.query(DiscordUser.id).filter(
+                DiscordUser.user_id.in_(member_ids[start:start + _IN_CHUNK_SIZE])
+            )
+        )
+    stored = {
+        discord_user_id for discord_user_id, in db.session.query(GuildMember.discord_user_id).filter_by(guild_id=guild_id)
+    }
+    if stored - members:
+        GuildMember.query.filter(
+            GuildMember.guild_id == guild_id,
+            GuildMember.discord_user_id.in_(stored - members)
+        ).delete(synchronize_session=False)
+    bulk_insert(GuildMember.__table__, [
+        {'guild_id': guild_id, 'discord_user_id': discord_user_id} for discord_user_id in members - stored
+    ])
+
+
+def remove_guild(guild_id: int):
+    GuildMember.query.filter_by(guild_id=guild_id).delete(synchronize_session=False)
+
+
 def get_guild_start_end_times(guild_id, start, end, archived=False):
 
     start = datetime.fromtimestamp(0) if not start else start
@@ -104,3 +232,381 @@ def get_guild_start_end_times(guild_id, start, end, archived=False):
         return max(start, event.start), min(end, event.end)
     else:
         return start, end
+
+
+def get_balances(client_id: int,
+                 since: datetime = None,
+                 to: datetime = None,
+                 limit: int = None,
+                 bucket: timedelta = None,
+                 currency: str = None) -> List[Balance]:
+    """
+    Loads the balances of a client inside the given range ordered by time.
+    A run which started before since but is still going on at since is included as well.
+    :param client_id: id of the client
+    :param since: Start of the range
+    :param to: End of the range
+    :param limit: Maximum amount of balances (the oldest ones are kept)
+    :param bucket: If given, only the last balance of each bucket of this size is loaded
+    :param currency: If given (and not $), only balances containing this currency are loaded, converted to it
+    """
+    if currency == '$':
+        currency = None
+
+    filters = [Balance.client_id == client_id]
+    if since:
+        filters.append(Balance.time >= since)
+    if to:
+        filters.append(Balance.time <= to)
+
+    query = _query_balances(currency).filter(*filters)
+    if bucket:
+        bucket_key = get_bucket_key(Balance.time, bucket)
+        ranked = db.session.query(
+            Balance.id,
+            db.func.row_number().over(partition_by=bucket_key, order_by=Balance.time.desc()).label('rank')
+        ).filter(*filters).subquery()
+        query = query.join(ranked, ranked.c.id == Balance.id).filter(ranked.c.rank == 1)
+
+    query = query.order_by(Balance.time)
+    if limit:
+        query = query.limit(limit)
+    results = query.all()
+
+    if since:
+        previous = _query_balances(currency).filter(
+            Balance.client_id == client_id, Balance.time < since
+        ).order_by(Balance.time.desc()).first()
+        if previous and previous.last_time and previous.last_time >= since:
+            results.insert(0, previous)
+
+    if currency:
+        return [
+            Balance(client_id=client_id, time=time, last_time=last_time, amount=amount, currency=currency)
+            for time, last_time, amount in results
+        ]
+    return results
+
+
+def get_bucket_key(column: db.Column, bucket: timedelta):
+    """
+    :return: Expression which is equal for all times inside the same bucket
+    """
+    return db.cast(db.extract('epoch', column), db.Integer) / int(bucket.total_seconds())
+
+
+async def async_get_compactable_balance_ids(session: AsyncSession,
+                                            client_id: int,
+                                            before: datetime,
+                                            bucket: timedelta,
+                                            keep: Iterable[int] = (),
+                                            limit: int = None) -> List[int]:
+    """
+    :return: ids of the balances before the given time which aren't the latest balance of their bucket
+    """
+    ranked = db.select(
+        Balance.id,
+        db.func.row_number().over(partition_by=get_bucket_key(Balance.time, bucket), order_by=Balance.time.desc()).label('rank')
+    ).filter(
+        Balance.client_id == client_id,
+        Balance.time < before
+    ).subquery()
+
+    statement = db.select(ranked.c.id).filter(ranked.c.rank > 1)
+    if keep:
+        statement = statement.filter(ranked.c.id.notin_(keep))
+    if limit:
+        statement = statement.limit(limit)
+    return (await session.execute(statement)).scalars().all()
+
+
+async def async_get_retained_balance_ids(session: AsyncSession, client_id: int) -> Set[int]:
+    """
+    :return: ids of the balances compaction has to keep: the first balance of the client and the first and latest
+    balance of each of its events (including a run which started before the event but may still cover its start)
+    """
+    statements = [_select_first_balance(client_id)]
+    events = await session.execute(
+        db.select(db_event.Event.start, db_event.Event.end).join(
+            db_event.association, db_event.association.c.event_id == db_event.Event.id
+        ).filter(db_event.association.c.client_id == client_id)
+    )
+    for start, end in events.all():
+        statements.append(_select_latest_balance(client_id, to=start))
+        statements.append(_select_first_balance(client_id, since=start, to=end))
+        statements.append(_select_latest_balance(client_id, to=end))
+
+    keep = set()
+    for statement in statements:
+        balance_id = (await session.execute(statement.with_only_columns([Balance.id]))).scalar()
+        if balance_id:
+            keep.add(balance_id)
+    return keep
+
+
+def _query_balances(currency: str = None):
+    if currency:
+        # Only the requested currency is read from the currencies column instead of deserializing it completely
+        amount = db.case(
+            (Balance.currency == currency, Balance.amount),
+            else_=db.func.coalesce(
+                *(Balance.extra_currencies[key].as_float() for key in (currency, CURRENCY_ALIASES.get(currency)) if key)
+            )
+        )
+        return db.session.query(Balance.time, Balance.last_time, amount.label('amount')).filter(amount != None)
+    return Balance.query
+
+
+def get_first_balance(client_id: int, since: datetime = None, to: datetime = None) -> Optional[Balance]:
+    """
+    :return: The first balance of the client inside the range (or the run which covers since)
+    """
+    if since:
+        previous = get_latest_balance(client_id, to=since - timedelta(microseconds=1))
+        if _covers(previous, since):
+            return previous
+    return db.session.execute(_select_first_balance(client_id, since, to)).scalars().first()
+
+
+def get_latest_balance(client_id: int, since: datetime = None, to: datetime = None) -> Optional[Balance]:
+    """
+    :return: The latest balance of the client inside the range (or the run which covers since)
+    """
+    result = db.session.execute(_select_latest_balance(client_id, to)).scalars().first()
+    if result and since and not _covers(result, since):
+        return None
+    return result
+
+
+def get_latest_balances(client_ids: Iterable[int]) -> Dict[int, Balance]:
+    """
+    Loads the latest balance of every given client with a single query.
+    :return: client id -> latest balance, clients without balances are missing
+    """
+    client_ids = list(client_ids)
+    if not client_ids:
+        return {}
+    rank = db.func.row_number().over(
+        partition_by=Balance.client_id,
+        order_by=Balance.time.desc()
+    ).label('rank')
+    ranked = db.session.query(Balance.id, rank).filter(Balance.client_id.in_(client_ids)).subquery()
+    return {
+        balance.client_id: balance
+        for balance in Balance.query.join(ranked, ranked.c.id == Balance.id).filter(ranked.c.rank == 1)
+    }
+
+
+def _select_first_balance(client_id: int, since: datetime = None, to: datetime = None):
+    filters = [Balance.client_id == client_id]
+    if since:
+        filters.append(Balance.time >= since)
+    if to:
+        filters.append(Balance.time <= to)
+    return db.select(Balance).filter(*filters).order_by(Balance.time).limit(1)
+
+
+def _select_latest_balance(client_id: int, to: datetime = None):
+    filters = [Balance.client_id == client_id]
+    if to:
+        filters.append(Balance.time <= to)
+    return db.select(Balance).filter(*filters).order_by(Balance.time.desc()).limit(1)
+
+
+def _covers(balance: Optional[Balance], since: datetime) -> bool:
+    return bool(balance) and balance.last_seen >= since
+
+
+def get_rollups(client_id: int,
+                resolution: str,
+                since: datetime = None,
+                to: datetime = None,
+                bucket: timedelta = None) -> List[BalanceRollup]:
+    """
+    Loads the rollups of a client whose bucket overlaps the given range ordered by time.
+    :param bucket: If given, only the last rollup of each bucket of this size is loaded
+    """
+    filters = [BalanceRollup.client_id == client_id, BalanceRollup.resolution == resolution]
+    if since:
+        filters.append(BalanceRollup.bucket >= get_bucket(since, resolution))
+    if to:
+        filters.append(BalanceRollup.bucket <= to)
+
+    query = BalanceRollup.query.filter(*filters)
+    if bucket:
+        ranked = db.session.query(
+            BalanceRollup.bucket,
+            db.func.row_number().over(
+                partition_by=get_bucket_key(BalanceRollup.bucket, bucket), order_by=BalanceRollup.bucket.desc()
+            ).label('rank')
+        ).filter(*filters).subquery()
+        query = query.join(ranked, ranked.c.bucket == BalanceRollup.bucket).filter(ranked.c.rank == 1)
+    return query.order_by(BalanceRollup.bucket).all()
+
+
+def rebuild_rollups(client_id: int, since: datetime, to: datetime):
+    """
+    Recomputes the rollups of every bucket overlapping the given range from the stored balances,
+    e.g. after the balances inside the range were deleted.
+    """
+    for resolution, size in RESOLUTIONS.items():
+        start = get_bucket(since, resolution)
+        end = get_bucket(to, resolution) + size
+        BalanceRollup.query.filter(
+            BalanceRollup.client_id == client_id,
+            BalanceRollup.resolution == resolution,
+            BalanceRollup.bucket >= start,
+            BalanceRollup.bucket < end
+        ).delete(synchronize_session=False)
+        # Only the partial buckets at the edges of the range still have balances
+        rows = _aggregate_rollups([
+            (client_id, balance.time, balance.amount)
+            for balance in expand_runs(get_balances(client_id, since=start, to=end))
+            if not balance.error and balance.currency == '$' and start <= balance.time < end
+        ], resolutions=[resolution])
+        if rows:
+            db.session.execute(BalanceRollup.__table__.insert(), rows)
+
+
+async def async_upsert_rollups(session: AsyncSession, points: Iterable[Tuple[int, datetime, float]]):
+    """
+    Merges $ balances into the rollups of every resolution.
+    PostgreSQL and SQLite get a single upsert statement, other databases select the existing rollups and update them.
+    :param points: (client_id, time, amount) ordered by time
+    """
+    rows = _aggregate_rollups(points)
+    if not rows:
+        return
+
+    dialect = session.bind.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        await session.execute(_get_rollup_upsert(rows, dialect))
+    else:
+        await _async_merge_rollups(session, rows)
+
+
+def _aggregate_rollups(points: Iterable[Tuple[int, datetime, float]],
+                       resolutions: Iterable[str] = RESOLUTIONS) -> List[Dict[str, Any]]:
+    """
+    :param points: (client_id, time, amount) ordered by time
+    :return: One rollup row per client, resolution and bucket
+    """
+    rows: Dict[Tuple[int, str, datetime], Dict[str, Any]] = {}
+    for client_id, time, amount in points:
+        for resolution in resolutions:
+            key = (client_id, resolution, get_bucket(time, resolution))
+            row = rows.get(key)
+            if row:
+                row['high'] = max(row['high'], amount)
+                row['low'] = min(row['low'], amount)
+                row['close'] = amount
+            else:
+                rows[key] = {
+                    'client_id': client_id,
+                    'resolution': resolution,
+                    'bucket': key[2],
+                    'open': amount,
+                    'high': amount,
+                    'low': amount,
+                    'close': amount
+                }
+    return list(rows.values())
+
+
+def _get_rollup_upsert(rows: List[Dict[str, Any]], dialect: str):
+    table = BalanceRollup.__table__
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        greatest, least = db.func.greatest, db.func.least
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+        greatest, least = db.func.max, db.func.min
+
+    statement = insert(table).values(rows)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.client_id, table.c.resolution, table.c.bucket],
+        set_={
+            'high': greatest(table.c.high, statement.excluded.high),
+            'low': least(table.c.low, statement.excluded.low),
+            'close': statement.excluded.close
+        }
+    )
+    return statement
+
+
+async def _async_merge_rollups(session: AsyncSession, rows: List[Dict[str, Any]]):
+    """
+    Portable upsert for databases without ON CONFLICT: existing rollups are updated one by one,
+    the new ones are inserted with a single executemany.
+    """
+    table = BalanceRollup.__table__
+    keys = [(row['client_id'], row['resolution'], row['bucket']) for row in rows]
+    existing = {}
+    for index in range(0, len(keys), _IN_CHUNK_SIZE):
+        result = await session.execute(
+            db.select(table.c.client_id, table.c.resolution, table.c.bucket, table.c.high, table.c.low).where(
+                db.tuple_(table.c.client_id, table.c.resolution, table.c.bucket).in_(keys[index:index + _IN_CHUNK_SIZE])
+            )
+        )
+        for client_id, resolution, bucket, high, low in result:
+            existing[(client_id, resolution, bucket)] = (high, low)
+
+    new_rows = []
+    for key, row in zip(keys, rows):
+        if key in existing:
+            high, low = existing[key]
+            await session.execute(
+                db.update(table).where(
+                    table.c.client_id == key[0], table.c.resolution == key[1], table.c.bucket == key[2]
+                ).values(high=max(high, row['high']), low=min(low, row['low']), close=row['close'])
+            )
+        else:
+            new_rows.append(row)
+    if new_rows:
+        await session.execute(table.insert(), new_rows)
+
+
+def bulk_insert(table: db.Table, rows: List[Dict[str, Any]]):
+    """
+    Inserts all rows in one go inside the current session transaction.
+    On PostgreSQL (psycopg2) the rows are streamed with COPY, every other backend gets a single executemany INSERT.
+    :param table: Table to insert into
+    :param rows: Dicts mapping column keys to values, all containing the same keys
+    """
+    if not rows:
+        return
+
+    connection = db.session.connection()
+    if connection.dialect.name == 'postgresql' and connection.dialect.driver == 'psycopg2':
+        columns = [column for column in table.columns if column.key in rows[0]]
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow([_copy_value(column, row[column.key]) for column in columns])
+        buffer.seek(0)
+
+        with connection.connection.cursor() as cursor:
+            cursor.copy_expert(
+                f'COPY {table.name} ({", ".join(column.name for column in columns)}) '
+                f'FROM STDIN WITH (FORMAT csv, NULL \'\\N\')',
+                buffer
+            )
+    else:
+        db.session.execute(table.insert(), rows)
+
+
+def _copy_value(column: db.Column, value: Any):
+    if value is None:
+        return '\\N'
+    if isinstance(column.type, db.PickleType):
+        value = column.type.pickler.dumps(value, column.type.protocol)
+    if isinstance(value, bytes):
+        # bytea hex format
+        return '\\x' + value.hex()
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (dict, list)):
+        # JSON columns
+        return json.dumps(value)
+    return value
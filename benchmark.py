@@ -0,0 +1,207 @@
+import argparse
+import asyncio
+import logging
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import List
+
+import dotenv
+dotenv.load_dotenv()
+import config
+from api.app import app
+from api.database import db
+from api.dbmodels.balance import Balance
+from api.dbmodels.client import Client
+from exchangeworker import ExchangeWorker
+from mockexchange import MockExchangeFarm, MockExchangeConfig
+from models.connectionpool import ConnectionPoolConfig
+from usermanager import UserManager
+
+parser = argparse.ArgumentParser(description="Benchmark fetch cycles against local mock exchanges. "
+                                             "Creates (and removes) synthetic clients, so point DATABASE_URI to a scratch database.")
+parser.add_argument("-n", "--clients", type=int, default=1000, help="Number of synthetic clients")
+parser.add_argument("-c", "--cycles", type=int, default=5, help="Number of fetch cycles")
+parser.add_argument("--exchanges", nargs='+', default=list(config.EXCHANGES), help="Exchanges the clients are spread across")
+parser.add_argument("--port", type=int, default=8700, help="Port of the first mock exchange")
+parser.add_argument("--latency", type=float, default=0.05, help="Response latency in seconds")
+parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 500")
+parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of requests answered with 429")
+parser.add_argument("--change-rate", type=float, default=0.1, help="Share of balance requests which change the balance")
+parser.add_argument("--rle", action="store_true", help="Store unchanged balances run length encoded")
+parser.add_argument("--memory", action="store_true",
+                    help="Trace the Python heap and the objects held by the bot's session per cycle, "
+                         "both should stay flat once the first cycles are done")
+parser.add_argument("--max-growth", type=float, default=None,
+                    help="Fail if the heap grows by more than this many MB or the session holds more objects "
+                         "between the second and the last cycle (implies --memory)")
+parser.add_argument("--secrets", action="store_true",
+                    help="Compare loading all clients (as the leaderboard does) with and without decrypting their api secrets")
+parser.add_argument("--streaming", action="store_true",
+                    help="Connect the private account streams to the mock exchanges and check that pushed account "
+                         "updates reach the live balances of the workers")
+parser.add_argument("-v", "--verbose", action="store_true", help="Show the log output of the fetching")
+
+args = parser.parse_args()
+if args.max_growth is not None:
+    args.memory = True
+
+_CLIENT_NAME = 'benchmark'
+
+
+def create_clients():
+    clients = []
+    for index in range(args.clients):
+        clients.append(
+            Client(
+                api_key=f'benchmark-{index}',
+                api_secret='benchmark',
+                exchange=args.exchanges[index % len(args.exchanges)],
+                extra_kwargs={'passphrase': 'benchmark'},
+                name=_CLIENT_NAME
+            )
+        )
+    db.session.add_all(clients)
+    db.session.commit()
+    return clients
+
+
+def remove_clients():
+    client_ids = [client_id for client_id, in db.session.query(Client.id).filter_by(name=_CLIENT_NAME)]
+    Balance.query.filter(Balance.client_id.in_(client_ids)).delete(synchronize_session=False)
+    Client.query.filter(Client.id.in_(client_ids)).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def measure_secrets(repeat=3):
+    """
+    Loads every synthetic client with the deferred api secret and with the secret undeferred (decrypted).
+    """
+    def load(*options):
+        durations = []
+        for _ in range(repeat):
+            db.session.expunge_all()
+            start = time.perf_counter()
+            Client.query.options(*options).filter_by(name=_CLIENT_NAME).all()
+            durations.append(time.perf_counter() - start)
+        return statistics.median(durations)
+
+    deferred = load()
+    decrypted = load(db.undefer(Client.api_secret))
+    print(f'Loading {args.clients} clients: {deferred:.3f}s deferred, {decrypted:.3f}s with decrypted secrets '
+          f'({(decrypted - deferred) / args.clients * 10**6:.1f}us per secret)')
+
+
+async def check_streams(farm: MockExchangeFarm, user_manager: UserManager, workers: List[ExchangeWorker]) -> bool:
+    """
+    Pushes an account update through every stream and checks that each streaming worker ends up with a live balance
+    which is stored by the live-only persisting.
+    """
+    streaming = [worker for worker in workers if worker.supports_streaming]
+    # Connecting, logging in and subscribing
+    await asyncio.sleep(2)
+    sent = await farm.push_account_updates()
+    # Account updates without a balance are followed by a REST refresh after a second
+    await asyncio.sleep(3)
+    live = [worker for worker in streaming if worker.get_live_balance()]
+    stored = await user_manager._async_fetch_data(streaming, live_only=True)
+    print(f'{len(streaming)} streaming workers, {sum(farm.streams.values())} streams connected, '
+          f'{sent} account updates pushed, {len(live)} live balances, {len(stored)} persisted')
+    return len(live) == len(stored) == len(streaming)
+
+
+async def run() -> bool:
+    success = True
+    farm = MockExchangeFarm(
+        MockExchangeConfig(
+            latency=args.latency,
+            error_rate=args.error_rate,
+            rate_limit_rate=args.rate_limit_rate,
+            change_rate=args.change_rate
+        ),
+        base_port=args.port
+    )
+    await farm.start()
+
+    exchanges = {exchange: config.EXCHANGES[exchange] for exchange in args.exchanges}
+    for exchange, exchange_cls in exchanges.items():
+        exchange_cls._ENDPOINT = farm.endpoints[exchange]
+        exchange_cls._WS_ENDPOINT = farm.ws_endpoints.get(exchange, '') if args.streaming else ''
+
+    user_manager = UserManager(exchanges=exchanges,
+                               connection_pool=ConnectionPoolConfig(
+                                   limit=config.HTTP_CONNECTION_LIMIT,
+                                   limit_per_host=config.HTTP_CONNECTION_LIMIT_PER_HOST,
+                                   keepalive_timeout=config.HTTP_KEEPALIVE_TIMEOUT_SECONDS,
+                                   dns_cache_ttl=config.HTTP_DNS_CACHE_TTL_SECONDS,
+                                   total_timeout=config.HTTP_TOTAL_TIMEOUT_SECONDS
+                               ),
+                               rekt_threshold=config.REKT_THRESHOLD,
+                               compress_balances=args.rle,
+                               streaming=args.streaming)
+
+    remove_clients()
+    try:
+        clients = create_clients()
+        user_manager._load_secrets(clients)
+        workers = [user_manager.add_client(client) for client in clients]
+        del clients
+        if args.secrets:
+            measure_secrets()
+        if args.streaming and not await check_streams(farm, user_manager, workers):
+            print('FAIL streaming: not every streaming worker received and persisted a live balance')
+            success = False
+
+        if args.memory:
+            tracemalloc.start()
+        print(f'{"cycle":>5} {"total":>8} {"fetch":>8} {"commit":>8} {"req/s":>8} {"stored":>7} {"errors":>7}'
+              + (f' {"heap":>9} {"session":>8}' if args.memory else ''))
+        durations, commits, rates, heaps, objects = [], [], [], [], []
+        for cycle in range(args.cycles):
+            farm.requests.clear()
+            farm.errors.clear()
+            await user_manager._async_fetch_data(workers, force_fetch=True)
+
+            stats = user_manager.last_cycle_stats
+            rate = sum(farm.requests.values()) / stats.fetch_duration if stats.fetch_duration else 0
+            durations.append(stats.duration)
+            commits.append(stats.commit_duration)
+            rates.append(rate)
+            line = f'{cycle:>5} {stats.duration:>7.3f}s {stats.fetch_duration:>7.3f}s {stats.commit_duration:>7.3f}s ' \
+                   f'{rate:>8.1f} {stats.stored:>7} {sum(farm.errors.values()):>7}'
+            if args.memory:
+                heap, _ = tracemalloc.get_traced_memory()
+                heaps.append(heap)
+                objects.append(len(db.session.identity_map))
+                line += f' {heap / 2**20:>7.1f}MB {objects[-1]:>8}'
+            print(line)
+
+        print(f'{args.clients} clients, {args.cycles} cycles: '
+              f'median cycle {statistics.median(durations):.3f}s, '
+              f'median commit {statistics.median(commits):.3f}s, '
+              f'median {statistics.median(rates):.1f} requests/s')
+        if len(heaps) > 2:
+            # The first cycle fills the caches (recent balances, prices, connections), growth is measured after it
+            growth = (heaps[-1] - heaps[1]) / 2**20
+            print(f'heap grew by {growth:.2f}MB and the session by {objects[-1] - objects[1]} objects after the second cycle')
+            if args.max_growth is not None and (growth > args.max_growth or objects[-1] > objects[1]):
+                print(f'FAIL memory: grew by more than {args.max_growth}MB or kept objects in the session')
+                success = False
+        elif args.max_growth is not None:
+            print('FAIL memory: at least 3 cycles are needed to measure growth')
+            success = False
+    finally:
+        if args.memory:
+            tracemalloc.stop()
+        for worker in user_manager._workers:
+            worker.disconnect()
+        remove_clients()
+        await user_manager.session.close()
+        await farm.stop()
+    return success
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    sys.exit(0 if asyncio.run(run()) else 1)
@@ -37,6 +37,20 @@ from exchangeworker import ExchangeWorker
 from config import (DATA_PATH,
                     PREFIX,
                     FETCHING_INTERVAL_HOURS,
+                    FETCHING_SPREAD,
+                    FETCHING_SPREAD_RESOLUTION_SECONDS,
+                    STREAMING,
+                    STREAM_PERSIST_INTERVAL_SECONDS,
+                    FETCHING_PROCESSES,
+                    BALANCE_RUN_LENGTH_ENCODING,
+                    BALANCE_RETENTION_DAYS,
+                    BALANCE_COMPACTION_RESOLUTION,
+                    BALANCE_COMPACTION_BATCH_SIZE,
+                    HTTP_CONNECTION_LIMIT,
+                    HTTP_CONNECTION_LIMIT_PER_HOST,
+                    HTTP_KEEPALIVE_TIMEOUT_SECONDS,
+                    HTTP_DNS_CACHE_TTL_SECONDS,
+                    HTTP_TOTAL_TIMEOUT_SECONDS,
                     REKT_MESSAGES,
                     LOG_OUTPUT_DIR,
                     REKT_GUILDS,
@@ -46,6 +60,7 @@ from config import (DATA_PATH,
                     EXCHANGES)
 from errors import UserInputError, InternalError
 from eventmanager import EventManager
+from models.connectionpool import ConnectionPoolConfig
 from usermanager import UserManager
 from utils import (de_emojify,
                    create_yes_no_button_row)
@@ -62,6 +77,9 @@ slash = SlashCommand(bot)
 @bot.event
 async def on_ready():
     user_manager.synch_workers()
+    for guild in bot.guilds:
+        dbutils.sync_guild_members(guild.id, (member.id for member in guild.members))
+    db.session.commit()
     event_manager.initialize_events()
     asyncio.create_task(user_manager.start_fetching())
 
@@ -96,6 +114,27 @@ async def on_guild_join(guild: discord.Guild):
                 )
     await slash.sync_all_commands(delete_from_unused_guilds=True)
 
+    dbutils.sync_guild_members(guild.id, (member.id for member in guild.members))
+    db.session.commit()
+
+
+@bot.event
+async def on_guild_remove(guild: discord.Guild):
+    dbutils.remove_guild(guild.id)
+    db.session.commit()
+
+
+@bot.event
+async def on_member_join(member: discord.Member):
+    dbutils.add_guild_member(member.guild.id, member.id)
+    db.session.commit()
+
+
+@bot.event
+async def on_member_remove(member: discord.Member):
+    dbutils.remove_guild_member(member.guild.id, member.id)
+    db.session.commit()
+
 
 @slash.slash(
     name="ping",
@@ -488,6 +527,11 @@ async def register_new(ctx: SlashContext,
 
                                 db.session.add(new_client)
                                 db.session.commit()
+
+                                for guild in bot.guilds:
+                                    if guild.get_member(discord_user.user_id):
+                                        dbutils.add_guild_member(guild.id, discord_user.user_id)
+                                db.session.commit()
                                 logger.info(f'Registered new user')
 
                             button_row = create_yes_no_button_row(
@@ -669,6 +713,7 @@ async def register_event(ctx: SlashContext, name: str, description: str, start:
     def register(ctx):
         db.session.add(event)
         db.session.commit()
+        dbutils.invalidate_events(event.guild_id)
         event_manager.register(event)
 
     row = create_yes_no_button_row(
@@ -1085,6 +1130,22 @@ async def archive(ctx: SlashContext):
 
 user_manager = UserManager(exchanges=EXCHANGES,
                            fetching_interval_hours=FETCHING_INTERVAL_HOURS,
+                           spread_fetching=FETCHING_SPREAD,
+                           spread_resolution_seconds=FETCHING_SPREAD_RESOLUTION_SECONDS,
+                           streaming=STREAMING,
+                           stream_persist_seconds=STREAM_PERSIST_INTERVAL_SECONDS,
+                           fetching_processes=FETCHING_PROCESSES,
+                           compress_balances=BALANCE_RUN_LENGTH_ENCODING,
+                           retention_days=BALANCE_RETENTION_DAYS,
+                           compaction_resolution=BALANCE_COMPACTION_RESOLUTION,
+                           compaction_batch_size=BALANCE_COMPACTION_BATCH_SIZE,
+                           connection_pool=ConnectionPoolConfig(
+                               limit=HTTP_CONNECTION_LIMIT,
+                               limit_per_host=HTTP_CONNECTION_LIMIT_PER_HOST,
+                               keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT_SECONDS,
+                               dns_cache_ttl=HTTP_DNS_CACHE_TTL_SECONDS,
+                               total_timeout=HTTP_TOTAL_TIMEOUT_SECONDS
+                           ),
                            data_path=DATA_PATH,
                            rekt_threshold=REKT_THRESHOLD,
                            on_rekt_callback=lambda user: bot.loop.create_task(on_rekt_async(user)))
@@ -0,0 +1,162 @@
+from __future__ import annotations
+import asyncio
+import logging
+import time
+from collections import Counter, OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, NamedTuple, Optional, Tuple
+
+
+class CacheEntry(NamedTuple):
+    value: Any
+    expires: float
+    # Until then the expired value may still be served while it is refreshed in the background
+    stale_until: float
+
+
+class TTLCache:
+    """
+    Size bounded LRU cache with per entry expiry, e.g. shared by all workers of the exchange layer.
+
+    Keys live in namespaces (e.g. one per exchange) so that stats can be told apart and a namespace can be cleared
+    on its own. Expired entries are dropped when they are accessed or when they reach the least recently used end,
+    once the cache is full the least recently used entries are evicted.
+
+    With `stale_ttl`, `get_or_fetch` keeps answering with an expired value for that long after it expired
+    and refreshes it in the background instead of making the caller wait (stale-while-revalidate).
+    Concurrent fetches of the same key are coalesced into one.
+    """
+
+    def __init__(self, name: str, maxsize: int = 1024, ttl: float = 5, stale_ttl: float = 0):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+
+        self._entries: OrderedDict[Tuple[str, Hashable], CacheEntry] = OrderedDict()
+        self._in_flight: Dict[Tuple[str, Hashable], asyncio.Future] = {}
+        # namespace -> hits, misses, stale, coalesced, evictions and expirations
+        self._stats: Dict[str, Counter] = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def stats(self) -> Counter:
+        """
+        :return: Stats summed over all namespaces
+        """
+        total = Counter()
+        for counter in self._stats.values():
+            total.update(counter)
+        return total
+
+    def get_stats(self, namespace: str) -> Counter:
+        return self._stats.setdefault(namespace, Counter())
+
+    def get(self, namespace: str, key: Hashable, default=None):
+        """
+        :return: The fresh value stored for the key or default
+        """
+        entry = self._get_entry((namespace, key))
+        if entry and time.monotonic() < entry.expires:
+            self.get_stats(namespace)['hits'] += 1
+            return entry.value
+        self.get_stats(namespace)['misses'] += 1
+        return default
+
+    def set(self, namespace: str, key: Hashable, value, ttl: float = None, stale_ttl: float = None):
+        now = time.monotonic()
+        expires = now + (self.ttl if ttl is None else ttl)
+        full_key = (namespace, key)
+        self._entries[full_key] = CacheEntry(
+            value=value,
+            expires=expires,
+            stale_until=expires + (self.stale_ttl if stale_ttl is None else stale_ttl)
+        )
+        self._entries.move_to_end(full_key)
+        self._evict(now)
+
+    def invalidate(self, namespace: str, key: Hashable):
+        self._entries.pop((namespace, key), None)
+
+    def clear(self, namespace: str = None):
+        if namespace is None:
+            self._entries.clear()
+        else:
+            for full_key in [full_key for full_key in self._entries if full_key[0] == namespace]:
+                del self._entries[full_key]
+
+    async def get_or_fetch(self,
+                           namespace: str,
+                           key: Hashable,
+                           fetch: Callable[[], Awaitable],
+                           ttl: float = None,
+                           stale_ttl: float = None):
+        """
+        Returns the cached value or fetches (and stores) it.
+        :param fetch: Coroutine function which downloads the value, exceptions are passed on to the caller
+        :param ttl: Overrides the ttl of the cache for this key
+        :param stale_ttl: Overrides the stale_ttl of the cache for this key
+        """
+        full_key = (namespace, key)
+        stats = self.get_stats(namespace)
+        entry = self._get_entry(full_key)
+        if entry:
+            if time.monotonic() < entry.expires:
+                stats['hits'] += 1
+                return entry.value
+            stats['stale'] += 1
+            if full_key not in self._in_flight:
+                self._start_fetch(full_key, fetch, ttl, stale_ttl).add_done_callback(self._log_refresh_error)
+            return entry.value
+
+        in_flight = self._in_flight.get(full_key)
+        if in_flight:
+            stats['coalesced'] += 1
+            # Shielded so a cancelled waiter doesn't cancel the request for everyone else
+            return await asyncio.shield(in_flight)
+
+        stats['misses'] += 1
+        return await asyncio.shield(self._start_fetch(full_key, fetch, ttl, stale_ttl))
+
+    def _start_fetch(self, full_key: Tuple[str, Hashable], fetch: Callable[[], Awaitable], ttl, stale_ttl) -> asyncio.Future:
+        async def run():
+            try:
+                value = await fetch()
+                self.set(*full_key, value, ttl=ttl, stale_ttl=stale_ttl)
+                return value
+            finally:
+                self._in_flight.pop(full_key, None)
+
+        future = asyncio.ensure_future(run())
+        self._in_flight[full_key] = future
+        return future
+
+    def _log_refresh_error(self, future: asyncio.Future):
+        # The stale value stays in place, the next caller retries
+        if not future.cancelled() and future.exception():
+            logging.error(f'Background refresh of {self.name} cache entry failed: {future.exception()!r}')
+
+    def _get_entry(self, full_key: Tuple[str, Hashable]) -> Optional[CacheEntry]:
+        entry = self._entries.get(full_key)
+        if entry:
+            if time.monotonic() >= entry.stale_until:
+                del self._entries[full_key]
+                self.get_stats(full_key[0])['expirations'] += 1
+                return None
+            self._entries.move_to_end(full_key)
+        return entry
+
+    def _evict(self, now: float):
+        while self._entries:
+            full_key, entry = next(iter(self._entries.items()))
+            if now >= entry.stale_until:
+                self.get_stats(full_key[0])['expirations'] += 1
+            elif len(self._entries) > self.maxsize:
+                self.get_stats(full_key[0])['evictions'] += 1
+            else:
+                break
+            del self._entries[full_key]
+
+    def __repr__(self):
+        return f'<TTLCache name={self.name} size={len(self._entries)}/{self.maxsize} ttl={self.ttl} stale_ttl={self.stale_ttl}>'
@@ -0,0 +1,73 @@
+from __future__ import annotations
+import logging
+import time
+
+
+class CircuitBreaker:
+    """
+    Keeps track of consecutive failures of an exchange (timeouts, connection errors, 5xx responses).
+
+    After `failure_threshold` consecutive failures the circuit opens and requests to the exchange are skipped.
+    Once the backoff has passed, a single probe is let through (half-open). If it succeeds the circuit closes again,
+    otherwise it reopens with twice the backoff (capped at `max_backoff`).
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name: str, failure_threshold: int = 5, base_backoff: float = 30, max_backoff: float = 3600):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.backoff = base_backoff
+        self._open_until = 0.0
+        self._probe_started = None
+
+    def allow(self) -> bool:
+        """
+        :return: whether a request to the exchange should be made right now
+        """
+        if self.state == self.CLOSED:
+            return True
+
+        now = time.monotonic()
+        if self.state == self.OPEN and now >= self._open_until:
+            self.state = self.HALF_OPEN
+            self._probe_started = None
+            logging.info(f'Circuit for {self.name} is half-open, probing')
+
+        if self.state == self.HALF_OPEN:
+            # A probe which never reported back (e.g. the worker didn't make a request) must not block forever
+            if self._probe_started is None or now - self._probe_started > self.base_backoff:
+                self._probe_started = now
+                return True
+        return False
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logging.info(f'Circuit for {self.name} closed again')
+        self.state = self.CLOSED
+        self.failures = 0
+        self.backoff = self.base_backoff
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN:
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+            self._open()
+        elif self.state == self.CLOSED and self.failures >= self.failure_threshold:
+            self._open()
+
+    def _open(self):
+        self.state = self.OPEN
+        self._open_until = time.monotonic() + self.backoff
+        logging.warning(f'Circuit for {self.name} opened after {self.failures} consecutive failures, '
+                        f'skipping requests for {self.backoff} seconds')
+
+    def __repr__(self):
+        return f'<CircuitBreaker name={self.name} state={self.state} failures={self.failures} backoff={self.backoff}>'
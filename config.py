@@ -11,6 +11,20 @@ PREFIX = "c "
 DATA_PATH = "data/"
 ARCHIVE_PATH = "archive/"
 FETCHING_INTERVAL_HOURS = 1
+# Fetch each client at its own slot inside the interval instead of all at once
+FETCHING_SPREAD = False
+FETCHING_SPREAD_RESOLUTION_SECONDS = 1
+# Keep live balances from private websocket streams for exchanges which support them
+STREAMING = False
+# Number of processes the fetching is sharded across (1 fetches on the bot's event loop)
+FETCHING_PROCESSES = 1
+STREAM_PERSIST_INTERVAL_SECONDS = 300
+# Store unchanged balances as a single row per run (first and last fetch) instead of one row per change
+BALANCE_RUN_LENGTH_ENCODING = False
+# Balances older than this many days are compacted to one balance per hour or day (None keeps everything)
+BALANCE_RETENTION_DAYS = None
+BALANCE_COMPACTION_RESOLUTION = 'hour'
+BALANCE_COMPACTION_BATCH_SIZE = 1000
 REKT_THRESHOLD = 0.5
 REGISTRATION_MINIMUM = 1
 REKT_MESSAGES = [
@@ -54,6 +68,13 @@ EXCHANGES = {
     'okx': OkxClient
 }
 
+# HTTP connection pool shared by all exchange workers
+HTTP_CONNECTION_LIMIT = 100
+HTTP_CONNECTION_LIMIT_PER_HOST = 30
+HTTP_KEEPALIVE_TIMEOUT_SECONDS = 30
+HTTP_DNS_CACHE_TTL_SECONDS = 300
+HTTP_TOTAL_TIMEOUT_SECONDS = 30
+
 LOG_OUTPUT_DIR = "LOGS/"
 TESTING = os.environ.get('TESTING') == 'True'
 
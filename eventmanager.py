@@ -33,11 +33,13 @@ class EventManager:
             self.register(event)
 
     def register(self, event: Event):
+        # Only the id is captured, the event is loaded again when the callback fires
+        # so that no ORM object outlives the session it was loaded in
         event_callbacks = [
-            (event.start, lambda: self._event_start(event)),
-            (event.end, lambda: self._event_end(event)),
-            (event.registration_start, lambda: self._event_registration_start(event)),
-            (event.registration_end, lambda: self._event_registration_end(event))
+            (event.start, self._event_start),
+            (event.end, self._event_end),
+            (event.registration_start, self._event_registration_start),
+            (event.registration_end, self._event_registration_end)
         ]
         now = datetime.now()
         for time, callback in event_callbacks:
@@ -45,7 +47,7 @@ class EventManager:
                 self._schedule(
                     FutureCallback(
                         time=time,
-                        callback=self._wrap_async(callback)
+                        callback=self._wrap_async(callback, event.id)
                     )
                 )
 
@@ -78,12 +80,25 @@ class EventManager:
     async def _event_registration_end(self, event: Event):
         await self._get_event_channel(event).send(content=f'Registration period for **{event.name}** has ended!')
 
-    def _wrap_async(self, coro):
+    def _wrap_async(self, coro, event_id: int):
         @wraps(coro)
         def func():
-            self._dc_client.loop.create_task(coro())
+            self._dc_client.loop.create_task(self._run_event_callback(coro, event_id))
         return func
 
+    async def _run_event_callback(self, coro, event_id: int):
+        """
+        Runs the callback in its own session scope: changes are committed on success and rolled back on errors.
+        """
+        try:
+            event = Event.query.get(event_id)
+            if event:
+                await coro(event)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            logging.exception(f'Unhandled exception during event callback {coro.__name__} of event {event_id}')
+
     def _schedule(self, callback: FutureCallback):
         with self._schedule_lock:
             self._scheduled.append(callback)
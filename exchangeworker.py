@@ -1,38 +1,48 @@
 from __future__ import annotations
 import abc
+import asyncio
 import logging
 import urllib.parse
 from datetime import datetime, timedelta
-from typing import List, Callable, Union, Dict
+from typing import List, Callable, Union, Dict, Optional
 import aiohttp.client
 from aiohttp import ClientResponse
-from typing import NamedTuple
 from requests import Request, Response, Session
 
 from api.dbmodels.client import Client
 from api.dbmodels.balance import Balance
-
-
-class Cached(NamedTuple):
-    url: str
-    response: dict
-    expires: datetime
+from ratelimiter import TokenBucket
+from circuitbreaker import CircuitBreaker
 
 
 class ExchangeWorker:
     __tablename__ = 'client'
     _ENDPOINT = ''
-    _cache: Dict[str, Cached] = {}
+
+    # Rate limit of the exchange host (weight per interval in seconds). None disables throttling
+    _RATE_LIMIT_WEIGHT: Optional[int] = None
+    _RATE_LIMIT_INTERVAL: float = 60
+    # Weight of specific paths, every other path costs 1
+    _WEIGHTS: Dict[str, int] = {}
+    _limiters: Dict[str, TokenBucket] = {}
+    circuit_breakers: Dict[str, CircuitBreaker] = {}
+
+    # Websocket endpoint of the private account stream, empty if the exchange doesn't support streaming
+    _WS_ENDPOINT = ''
+    # Live balances older than this are refreshed over REST instead. Quiet accounts don't push updates, so this has
+    # to be well above the persist interval, otherwise every streaming worker would still be polled each interval
+    _LIVE_BALANCE_MAX_AGE = timedelta(hours=1)
 
     exchange: str = ''
     required_extra_args: List[str] = []
 
     def __init__(self, client: Client, session: aiohttp.ClientSession):
-        self.client = client
         self.client_id = client.id
         self.exchange = client.exchange
 
         # Client information has to be stored locally because SQL Objects aren't allowed to live in multiple threads
+        # and workers outlive the session the client was loaded in
+        self.rekt_on = client.rekt_on
         self._api_key = client.api_key
         self._api_secret = client.api_secret
         self._subaccount = client.subaccount
@@ -42,10 +52,106 @@ class ExchangeWorker:
         self._identifier = id
         self._last_fetch = datetime.fromtimestamp(0)
 
+        self._live_balance: Optional[Balance] = None
+        self._stream_task: Optional[asyncio.Task] = None
+        self._live_update: Optional[asyncio.Task] = None
+
+    @property
+    def circuit_breaker(self) -> CircuitBreaker:
+        breaker = ExchangeWorker.circuit_breakers.get(self.exchange)
+        if not breaker:
+            breaker = CircuitBreaker(self.exchange)
+            ExchangeWorker.circuit_breakers[self.exchange] = breaker
+        return breaker
+
+    @property
+    def supports_streaming(self) -> bool:
+        return bool(self._WS_ENDPOINT)
+
+    @property
+    def is_streaming(self) -> bool:
+        return self._stream_task is not None
+
+    def connect(self):
+        """
+        Starts listening to the private account stream of the exchange (if supported).
+        Account changes keep the live balance up to date, so get_balance doesn't have to hit the REST api.
+        """
+        if self.supports_streaming and not self._stream_task:
+            self._stream_task = asyncio.create_task(self._run_stream())
+
+    def disconnect(self):
+        for task in (self._stream_task, self._live_update):
+            if task:
+                task.cancel()
+        self._stream_task = None
+        self._live_update = None
+        self._live_balance = None
+
+    async def _run_stream(self):
+        delay = 1
+        while True:
+            try:
+                await self._stream()
+                delay = 1
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception(f'Exception occured in account stream of {self}')
+            # Reconnect with exponential backoff
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 300)
+
+    @abc.abstractmethod
+    async def _stream(self):
+        """
+        Connects to the private account stream and reports account changes through _on_account_update or _set_live_balance.
+        Should return when the connection is closed.
+        """
+        logging.error(f'Exchange {self.exchange} does not implement _stream')
+
+    def _on_account_update(self):
+        """
+        Schedules a refresh of the live balance after the stream reported an account change.
+        Bursts of updates (e.g. a filled order changing position and balance) are merged into one refresh.
+        """
+        if self._live_update is None or self._live_update.done():
+            self._live_update = asyncio.create_task(self._refresh_live_balance())
+
+    async def _refresh_live_balance(self):
+        await asyncio.sleep(1)
+        await self.get_balance(self._session, force=True)
+
+    def _set_live_balance(self, balance: Balance):
+        if not balance.time:
+            balance.time = datetime.now()
+        self._live_balance = balance
+
+    def get_live_balance(self, time: datetime = None, any_age=False) -> Optional[Balance]:
+        """
+        :param any_age: whether live balances older than _LIVE_BALANCE_MAX_AGE are returned as well
+        :return: Copy of the live balance at the given time or None if there is no recent one
+        """
+        time = time or datetime.now()
+        live = self._live_balance
+        if live and (any_age or time - live.time < self._LIVE_BALANCE_MAX_AGE):
+            return Balance(
+                amount=live.amount,
+                currency=live.currency,
+                extra_currencies=dict(live.extra_currencies) if live.extra_currencies else {},
+                error=None,
+                time=time,
+                client_id=self.client_id
+            )
+
     async def get_balance(self, session, time: datetime = None, force=False):
         if not time:
             time = datetime.now()
-        if force or (time - self._last_fetch > timedelta(seconds=30) and not self.client.rekt_on):
+        if not force and self.is_streaming and not self.rekt_on:
+            live = self.get_live_balance(time)
+            if live:
+                return live
+        if force or (time - self._last_fetch > timedelta(seconds=30) and not self.rekt_on):
             self._last_fetch = time
             try:
                 balance = await self._get_balance(time)
@@ -56,8 +162,10 @@ class ExchangeWorker:
             if not balance.time:
                 balance.time = time
             balance.client_id = self.client_id
+            if self.is_streaming and not balance.error:
+                self._set_live_balance(balance)
             return balance
-        elif self.client.rekt_on:
+        elif self.rekt_on:
             return Balance(amount=0.0, currency='$', extra_currencies={}, error=None, time=time)
         else:
             return None
@@ -75,25 +183,60 @@ class ExchangeWorker:
     async def _process_response(self, response: ClientResponse):
         logging.error(f'Exchange {self.exchange} does not implement _process_response')
 
-    async def _request(self, method: str, path: str, headers=None, params=None, data=None, sign=True, cache=False, **kwargs):
+    def _get_used_weight(self, response: ClientResponse) -> Optional[int]:
+        """
+        Can be overridden by exchanges which report the weight used in the current rate limit window.
+        :return: Used weight or None if the exchange doesn't report it
+        """
+        return None
+
+    def _get_limiter(self) -> Optional[TokenBucket]:
+        if self._RATE_LIMIT_WEIGHT is None:
+            return None
+        host = urllib.parse.urlparse(self._ENDPOINT).netloc
+        limiter = ExchangeWorker._limiters.get(host)
+        if not limiter:
+            limiter = TokenBucket(self._RATE_LIMIT_WEIGHT, self._RATE_LIMIT_INTERVAL, name=host)
+            ExchangeWorker._limiters[host] = limiter
+        return limiter
+
+    def _update_limiter(self, limiter: TokenBucket, response: ClientResponse):
+        if response.status == 429 or response.status == 418:
+            try:
+                retry_after = float(response.headers.get('Retry-After', self._RATE_LIMIT_INTERVAL))
+            except ValueError:
+                retry_after = self._RATE_LIMIT_INTERVAL
+            limiter.pause(retry_after)
+        else:
+            used = self._get_used_weight(response)
+            if used is not None:
+                limiter.update_used(used)
+
+    async def _request(self, method: str, path: str, headers=None, params=None, data=None, sign=True, **kwargs):
         headers = headers or {}
         params = params or {}
         url = self._ENDPOINT + path
-        if cache:
-            cached = ExchangeWorker._cache.get(url)
-            if cached and datetime.now() < cached.expires:
-                return cached.response
+        return await self._perform_request(method, path, url, headers, params, data, sign, **kwargs)
+
+    async def _perform_request(self, method: str, path: str, url: str, headers: Dict, params: Dict, data, sign: bool, **kwargs):
+        limiter = self._get_limiter()
+        if limiter:
+            await limiter.acquire(self._WEIGHTS.get(path, 1))
         if sign:
             self._sign_request(method, path, headers, params, data)
-        async with self._session.request(method, url, headers=headers, params=params, data=data, **kwargs) as resp:
-            resp = await self._process_response(resp)
-            if cache:
-                ExchangeWorker._cache[url] = Cached(
-                    url=url,
-                    response=resp,
-                    expires=datetime.now() + timedelta(seconds=5)
-                )
-            return resp
+        breaker = self.circuit_breaker
+        try:
+            async with self._session.request(method, url, headers=headers, params=params, data=data, **kwargs) as resp:
+                if resp.status >= 500:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                if limiter:
+                    self._update_limiter(limiter, resp)
+                return await self._process_response(resp)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            breaker.record_failure()
+            raise
 
     async def _get(self, path: str, **kwargs):
         return await self._request('GET', path, **kwargs)
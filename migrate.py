@@ -1,4 +1,5 @@
 import argparse
+import asyncio
 import json
 import logging
 import shutil
@@ -8,8 +9,9 @@ dotenv.load_dotenv()
 from datetime import datetime, timedelta
 import config
 from api.app import app
-from api.database import db
-from api.dbmodels.balance import balance_from_json
+from api.database import db, async_session
+import api.dbutils as dbutils
+from api.dbmodels.balance import Balance, balance_from_json, expand_runs
 from api.dbmodels.client import Client
 from api.dbmodels.discorduser import add_user_from_json, DiscordUser
 from api.dbmodels.event import Event
@@ -21,6 +23,8 @@ parser.add_argument("-e", "--event", action="store_true", help="Specifying this
 parser.add_argument("-u", "--users", action="store_true", help="Specifying this puts the users.json the database.")
 parser.add_argument("-d", "--data", action="store_true", help="Specifying this puts the current data into a database.")
 parser.add_argument("-a", "--archive", action="store_true", help="Create archive for old events")
+parser.add_argument("-c", "--currencies", action="store_true", help="Move pickled extra currencies of balances into the json column")
+parser.add_argument("-r", "--rollups", action="store_true", help="Backfill the hourly and daily balance rollups from existing balances")
 
 args = parser.parse_args()
 
@@ -163,3 +167,48 @@ if args.event:
     db.session.commit()
 
     print('Created dev event. Do not run this again to avoid duplication')
+if args.currencies:
+    migrated = 0
+    while True:
+        balances = Balance.query.filter(
+            Balance.legacy_extra_currencies != None
+        ).options(
+            db.undefer(Balance.legacy_extra_currencies)
+        ).limit(1000).all()
+        if not balances:
+            break
+        for balance in balances:
+            if balance.extra_currencies is None:
+                balance.extra_currencies = balance.legacy_extra_currencies
+            balance.legacy_extra_currencies = None
+        db.session.commit()
+        migrated += len(balances)
+        print(f'Migrated extra currencies of {migrated} balances')
+    print('Done migrating extra currencies. The legacy extra_currencies column can be dropped now')
+
+
+async def backfill_rollups():
+    async with async_session() as session:
+        client_ids = (await session.execute(db.select(Client.id))).scalars().all()
+        for client_id in client_ids:
+            since = None
+            while True:
+                filters = [Balance.client_id == client_id, Balance.currency == '$', Balance.error == None]
+                if since:
+                    filters.append(Balance.time > since)
+                balances = (await session.execute(
+                    db.select(Balance).filter(*filters).order_by(Balance.time).limit(5000)
+                )).scalars().all()
+                if not balances:
+                    break
+                await dbutils.async_upsert_rollups(
+                    session, [(client_id, balance.time, balance.amount) for balance in expand_runs(balances)]
+                )
+                since = balances[-1].time
+            await session.commit()
+            print(f'Backfilled rollups of client {client_id}')
+
+
+if args.rollups:
+    asyncio.run(backfill_rollups())
+    print('Done backfilling rollups')
@@ -0,0 +1,334 @@
+import argparse
+import asyncio
+import json
+import logging
+import random
+import zlib
+from collections import Counter
+from typing import Dict, Callable, NamedTuple, Tuple, List
+
+from aiohttp import web, WSMsgType
+
+
+class MockExchangeConfig(NamedTuple):
+    # Seconds every response is delayed by (uniformly +- jitter)
+    latency: float = 0.05
+    jitter: float = 0.02
+    # Share of requests answered with a 500 or 429
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    retry_after: int = 1
+    # Share of balance requests for which the account balance moves
+    change_rate: float = 0.1
+
+
+# Satisfies the error handling of every adapter
+_ERROR_BODY = {
+    'error': 'Mock error',
+    'msg': 'Mock error',
+    'ret_msg': 'Mock error',
+    'ret_code': 1,
+    'code': '1',
+    'success': False
+}
+
+_PRICES = {
+    'BTC': 40000.0,
+    'ETH': 3000.0,
+    'SOL': 100.0
+}
+
+
+def _binance_futures_account(balance: float):
+    return {'assets': [{'asset': 'USDT', 'marginBalance': str(balance)}]}
+
+
+def _binance_spot_account(balance: float):
+    return {
+        'balances': [
+            {'asset': 'USDT', 'free': str(balance / 2), 'locked': '0'},
+            {'asset': 'BTC', 'free': str(balance / 2 / _PRICES['BTC']), 'locked': '0'}
+        ]
+    }
+
+
+def _binance_spot_tickers(balance: float):
+    return [{'symbol': f'{currency}USDT', 'price': str(price)} for currency, price in _PRICES.items()]
+
+
+def _bybit_wallet(balance: float):
+    return {
+        'ret_code': 0,
+        'ret_msg': 'OK',
+        'result': {
+            'USDT': {'equity': balance / 2},
+            'BTC': {'equity': balance / 2 / _PRICES['BTC']}
+        }
+    }
+
+
+def _bybit_tickers(balance: float):
+    return {
+        'ret_code': 0,
+        'ret_msg': 'OK',
+        'result': [{'symbol': f'{currency}USD', 'last_price': str(price)} for currency, price in _PRICES.items()]
+    }
+
+
+def _ftx_balances(balance: float):
+    return {'success': True, 'result': [{'coin': 'USD', 'usdValue': balance}]}
+
+
+def _kucoin_overview(balance: float):
+    return {'code': '200000', 'data': {'accountEquity': balance}}
+
+
+def _bitmex_margin(balance: float):
+    return [
+        {'currency': 'XBt', 'marginBalance': int(balance / 2 / _PRICES['BTC'] * 10**8)},
+        {'currency': 'USDt', 'marginBalance': int(balance / 2 * 10**6)}
+    ]
+
+
+def _bitmex_instruments(balance: float):
+    return [
+        {'typ': 'FFWCSX', 'quoteCurrency': 'USD', 'underlying': 'XBT' if currency == 'BTC' else currency, 'lastPrice': price}
+        for currency, price in _PRICES.items()
+    ]
+
+
+def _okx_balance(balance: float):
+    return {
+        'code': '0',
+        'msg': '',
+        'data': [{'totalEq': str(balance), 'details': [{'ccy': 'USDT', 'eq': str(balance)}]}]
+    }
+
+
+def _listen_key(balance: float):
+    return {'listenKey': 'mock'}
+
+
+# exchange -> (header or query parameter carrying the api key, {(method, path): handler})
+MOCK_EXCHANGES: Dict[str, Tuple[str, Dict[Tuple[str, str], Callable[[float], object]]]] = {
+    'binance-futures': ('X-MBX-APIKEY', {
+        ('GET', '/fapi/v2/account'): _binance_futures_account,
+        ('POST', '/fapi/v1/listenKey'): _listen_key,
+        ('PUT', '/fapi/v1/listenKey'): _listen_key
+    }),
+    'binance-spot': ('X-MBX-APIKEY', {
+        ('GET', '/api/v3/account'): _binance_spot_account,
+        ('GET', '/api/v3/ticker/price'): _binance_spot_tickers,
+        ('POST', '/api/v3/userDataStream'): _listen_key,
+        ('PUT', '/api/v3/userDataStream'): _listen_key
+    }),
+    'bybit': ('api_key', {
+        ('GET', '/v2/private/wallet/balance'): _bybit_wallet,
+        ('GET', '/v2/public/tickers'): _bybit_tickers
+    }),
+    'ftx': ('FTX-KEY', {
+        ('GET', '/api/wallet/balances'): _ftx_balances
+    }),
+    'kucoin': ('KC-API-KEY', {
+        ('GET', '/api/v1/account-overview'): _kucoin_overview
+    }),
+    'bitmex': ('api-key', {
+        ('GET', '/api/v1/user/margin'): _bitmex_margin,
+        ('GET', '/api/v1/instrument/active'): _bitmex_instruments
+    }),
+    'okx': ('OK-ACCESS-KEY', {
+        ('GET', '/api/v5/account/balance'): _okx_balance
+    })
+}
+
+# Path prefix which is part of the endpoint of the adapter
+MOCK_ENDPOINT_PATHS = {
+    'binance-spot': '/api/v3'
+}
+
+
+def _binance_futures_push(balance: float):
+    return {'e': 'ACCOUNT_UPDATE'}
+
+
+def _binance_spot_push(balance: float):
+    return {'e': 'outboundAccountPosition'}
+
+
+def _bybit_push(balance: float):
+    return {'topic': 'position', 'data': []}
+
+
+def _okx_push(balance: float):
+    return {'arg': {'channel': 'account'}, 'data': [{'totalEq': str(balance)}]}
+
+
+def _stream_reply(data: dict):
+    # Acknowledges login, auth, subscribe and ping requests in a way every adapter accepts
+    return {'event': data.get('op'), 'code': '0', 'success': True, 'request': data}
+
+
+# exchange -> (route of the private account stream, endpoint path of the adapter, message pushed on account changes)
+MOCK_STREAMS: Dict[str, Tuple[str, str, Callable[[float], object]]] = {
+    'binance-futures': ('/ws/{listen_key}', '/ws/', _binance_futures_push),
+    'binance-spot': ('/ws/{listen_key}', '/ws/', _binance_spot_push),
+    'bybit': ('/realtime', '/realtime', _bybit_push),
+    'okx': ('/ws/v5/private', '/ws/v5/private', _okx_push)
+}
+
+
+class MockExchangeFarm:
+    """
+    Local stand-in for the exchange REST APIs used by the adapters, one server per exchange (port) so that
+    per host rate limiting and connection pooling behave like they do against the real exchanges.
+    Signatures are not verified. Every api key has its own balance which moves randomly according to change_rate.
+    Exchanges with a private account stream get a websocket route as well, push_account_updates notifies every open stream.
+    """
+
+    def __init__(self, config: MockExchangeConfig = None, host: str = '127.0.0.1', base_port: int = 8700):
+        self.config = config or MockExchangeConfig()
+        self.host = host
+        self.base_port = base_port
+        self.requests = Counter()
+        self.errors = Counter()
+        # Stream connections per exchange
+        self.streams = Counter()
+
+        self._balances: Dict[str, Dict[str, float]] = {}
+        self._runners: List[web.AppRunner] = []
+        # open stream -> (exchange, api key if the stream logged in with it)
+        self._sockets: Dict[web.WebSocketResponse, Tuple[str, str]] = {}
+        self.endpoints: Dict[str, str] = {}
+        self.ws_endpoints: Dict[str, str] = {}
+
+    async def start(self):
+        for index, exchange in enumerate(MOCK_EXCHANGES):
+            port = self.base_port + index
+            runner = web.AppRunner(self._create_app(exchange))
+            await runner.setup()
+            await web.TCPSite(runner, self.host, port).start()
+            self._runners.append(runner)
+            self.endpoints[exchange] = f'http://{self.host}:{port}{MOCK_ENDPOINT_PATHS.get(exchange, "")}'
+            if exchange in MOCK_STREAMS:
+                self.ws_endpoints[exchange] = f'ws://{self.host}:{port}{MOCK_STREAMS[exchange][1]}'
+            logging.info(f'Mock {exchange} listening on {self.endpoints[exchange]}')
+
+    async def push_account_updates(self) -> int:
+        """
+        Sends an account update to every open stream.
+        :return: Number of updates sent
+        """
+        sent = 0
+        for ws, (exchange, api_key) in list(self._sockets.items()):
+            if not ws.closed:
+                balance = self._get_balance(exchange, api_key) if api_key else 0.0
+                await ws.send_json(MOCK_STREAMS[exchange][2](balance))
+                sent += 1
+        return sent
+
+    async def stop(self):
+        for ws in list(self._sockets):
+            await ws.close()
+        for runner in self._runners:
+            await runner.cleanup()
+        self._runners.clear()
+
+    def _create_app(self, exchange: str) -> web.Application:
+        key_name, routes = MOCK_EXCHANGES[exchange]
+        app = web.Application()
+
+        for (method, path), handler in routes.items():
+            async def handle(request: web.Request, handler=handler):
+                return await self._handle(exchange, key_name, handler, request)
+            app.router.add_route(method, path, handle)
+
+        if exchange in MOCK_STREAMS:
+            async def handle_stream(request: web.Request):
+                return await self._handle_stream(exchange, request)
+            app.router.add_get(MOCK_STREAMS[exchange][0], handle_stream)
+        return app
+
+    async def _handle_stream(self, exchange: str, request: web.Request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.streams[exchange] += 1
+        self._sockets[ws] = (exchange, '')
+        try:
+            async for message in ws:
+                if message.type != WSMsgType.TEXT:
+                    continue
+                if message.data == 'ping':
+                    await ws.send_str('pong')
+                    continue
+                data = json.loads(message.data)
+                if data.get('op') == 'login':
+                    self._sockets[ws] = (exchange, data['args'][0]['apiKey'])
+                await ws.send_json(_stream_reply(data))
+        finally:
+            self._sockets.pop(ws, None)
+        return ws
+
+    async def _handle(self, exchange: str, key_name: str, handler: Callable[[float], object], request: web.Request):
+        config = self.config
+        self.requests[exchange] += 1
+        await asyncio.sleep(max(config.latency + random.uniform(-config.jitter, config.jitter), 0))
+
+        roll = random.random()
+        if roll < config.rate_limit_rate:
+            self.errors[exchange] += 1
+            return web.json_response(_ERROR_BODY, status=429, headers={'Retry-After': str(config.retry_after)})
+        if roll < config.rate_limit_rate + config.error_rate:
+            self.errors[exchange] += 1
+            return web.json_response(_ERROR_BODY, status=500)
+
+        api_key = request.headers.get(key_name) or request.query.get(key_name, '')
+        return web.json_response(handler(self._get_balance(exchange, api_key)))
+
+    def _get_balance(self, exchange: str, api_key: str) -> float:
+        balances = self._balances.setdefault(exchange, {})
+        balance = balances.get(api_key)
+        if balance is None:
+            # Stable starting balance per key so runs are comparable
+            balance = 100 + zlib.crc32(api_key.encode()) % 10000
+        elif random.random() < self.config.change_rate:
+            balance *= random.uniform(0.95, 1.05)
+        balances[api_key] = balance
+        return balance
+
+
+async def _serve(farm: MockExchangeFarm):
+    await farm.start()
+    try:
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        await farm.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run local mock exchanges.")
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8700, help="Port of the first exchange, the others follow")
+    parser.add_argument("--latency", type=float, default=0.05, help="Response latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of requests answered with 429")
+    parser.add_argument("--change-rate", type=float, default=0.1, help="Share of balance requests which change the balance")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    try:
+        asyncio.run(_serve(MockExchangeFarm(
+            MockExchangeConfig(
+                latency=args.latency,
+                jitter=args.jitter,
+                error_rate=args.error_rate,
+                rate_limit_rate=args.rate_limit_rate,
+                change_rate=args.change_rate
+            ),
+            host=args.host,
+            base_port=args.port
+        )))
+    except KeyboardInterrupt:
+        pass
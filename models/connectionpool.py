@@ -0,0 +1,16 @@
+from __future__ import annotations
+from typing import NamedTuple
+
+
+class ConnectionPoolConfig(NamedTuple):
+    limit: int = 100
+    limit_per_host: int = 30
+    keepalive_timeout: float = 30
+    dns_cache_ttl: int = 300
+    total_timeout: float = 30
+
+
+class ConnectionPoolStats(NamedTuple):
+    open: int
+    idle: int
+    waiting: int
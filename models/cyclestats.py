@@ -0,0 +1,13 @@
+from __future__ import annotations
+from datetime import datetime
+from typing import NamedTuple
+
+
+class CycleStats(NamedTuple):
+    time: datetime
+    workers: int
+    fetched: int
+    stored: int
+    duration: float
+    fetch_duration: float
+    commit_duration: float
@@ -0,0 +1,11 @@
+from __future__ import annotations
+from datetime import datetime
+from typing import NamedTuple
+
+
+class EventWindow(NamedTuple):
+    id: int
+    registration_start: datetime
+    registration_end: datetime
+    start: datetime
+    end: datetime
@@ -0,0 +1,8 @@
+from __future__ import annotations
+from datetime import datetime
+from typing import NamedTuple
+
+
+class RecentBalance(NamedTuple):
+    time: datetime
+    amount: float
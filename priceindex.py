@@ -0,0 +1,42 @@
+from __future__ import annotations
+import logging
+from datetime import timedelta
+from typing import Dict, Optional, Callable, Awaitable
+
+from cache import TTLCache
+
+
+class PriceIndex:
+    """
+    Symbol -> price map which is shared between all workers of an exchange.
+    Prices are refreshed at most once per ttl, concurrent callers wait for the same refresh.
+    Expired prices are served while they are refreshed in the background. If a refresh fails,
+    the previous prices are kept (for up to stale_ttl) and the next caller tries again.
+    """
+
+    # Shared by all exchanges, each index uses its name as namespace
+    cache = TTLCache('prices', maxsize=64)
+
+    def __init__(self, name: str, ttl: timedelta = timedelta(minutes=1), stale_ttl: timedelta = timedelta(hours=1)):
+        self.name = name
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+
+    async def get_prices(self, fetch: Callable[[], Awaitable[Optional[Dict[str, float]]]]) -> Dict[str, float]:
+        """
+        :param fetch: Coroutine function which downloads the current prices (or None on failure) if a refresh is needed
+        :return: The current prices
+        """
+        async def update():
+            prices = await fetch()
+            if not prices:
+                raise ValueError(f'No {self.name} prices received')
+            return prices
+
+        try:
+            return await PriceIndex.cache.get_or_fetch(
+                self.name, 'prices', update, ttl=self.ttl.total_seconds(), stale_ttl=self.stale_ttl.total_seconds()
+            )
+        except Exception:
+            logging.exception(f'Exception occured while refreshing {self.name} prices')
+            return {}
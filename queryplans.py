@@ -0,0 +1,157 @@
+import argparse
+import json
+import random
+import sys
+from datetime import datetime, timedelta
+
+import dotenv
+dotenv.load_dotenv()
+from api.app import app
+from api.database import db
+import api.dbutils as dbutils
+from api.dbmodels.balance import Balance
+from api.dbmodels.client import Client
+from api.dbmodels.discorduser import DiscordUser
+from api.dbmodels.event import Event, association
+from api.dbmodels.guildmember import GuildMember
+
+parser = argparse.ArgumentParser(description="Check that the hot queries use indexes. "
+                                             "Seeds (and removes) a large synthetic dataset, so point DATABASE_URI to a local PostgreSQL scratch database.")
+parser.add_argument("-c", "--clients", type=int, default=500, help="Number of synthetic clients")
+parser.add_argument("-b", "--balances", type=int, default=2000, help="Number of balances per client")
+parser.add_argument("-k", "--keep", action="store_true", help="Keep the seeded data for further runs")
+parser.add_argument("-v", "--verbose", action="store_true", help="Print the plans")
+
+args = parser.parse_args()
+
+_NAME = 'queryplans'
+# Tables which must never be scanned sequentially by the hot queries
+_CHECKED_TABLES = ('balance', 'association', 'discorduser', 'guildmember')
+_GUILDS = 50
+
+
+def seed():
+    now = datetime.now()
+    event = Event(guild_id=0, channel_id=0, registration_start=now, registration_end=now,
+                  start=now - timedelta(days=30), end=now, name=_NAME, description=_NAME)
+    users = [DiscordUser(user_id=index, name=_NAME) for index in range(args.clients)]
+    clients = [
+        Client(api_key=_NAME, api_secret=_NAME, exchange='ftx', name=_NAME, discorduser=user)
+        for user in users
+    ]
+    event.registrations = clients
+    db.session.add(event)
+    db.session.add_all(users)
+    db.session.commit()
+
+    # Users are spread across guilds, a leaderboard only selects one of them
+    dbutils.bulk_insert(GuildMember.__table__, [
+        {'guild_id': index % _GUILDS, 'discord_user_id': user.id} for index, user in enumerate(users)
+    ])
+    for client in clients:
+        dbutils.bulk_insert(Balance.__table__, [
+            {
+                'client_id': client.id,
+                'time': now - timedelta(hours=index),
+                'amount': random.uniform(0, 1000),
+                'currency': '$',
+                'error': None,
+                'currencies': None
+            }
+            for index in range(args.balances)
+        ])
+    db.session.commit()
+
+
+def remove():
+    client_ids = [client_id for client_id, in db.session.query(Client.id).filter_by(name=_NAME)]
+    Balance.query.filter(Balance.client_id.in_(client_ids)).delete(synchronize_session=False)
+    Event.query.filter_by(name=_NAME).delete(synchronize_session=False)
+    Client.query.filter(Client.id.in_(client_ids)).delete(synchronize_session=False)
+    DiscordUser.query.filter_by(name=_NAME).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def hot_queries(client: Client):
+    now = datetime.now()
+    since = now - timedelta(days=1)
+    rank = db.func.row_number().over(partition_by=Balance.client_id, order_by=Balance.time.desc()).label('rank')
+    return {
+        'history': Balance.query.filter(Balance.client_id == client.id).order_by(Balance.time),
+        'history range': Balance.query.filter(
+            Balance.client_id == client.id, Balance.time >= since, Balance.time <= now
+        ).order_by(Balance.time),
+        'first balance': Balance.query.filter(
+            Balance.client_id == client.id, Balance.time >= since
+        ).order_by(Balance.time).limit(1),
+        'latest balance': Balance.query.filter(
+            Balance.client_id == client.id, Balance.time <= now
+        ).order_by(Balance.time.desc()).limit(1),
+        'recent balances': db.session.query(
+            Balance.client_id, Balance.time, Balance.amount, rank
+        ).filter(Balance.client_id.in_([client.id])),
+        'client events': db.session.query(association).filter(association.c.client_id == client.id),
+        'event registration': Client.query.join(association, association.c.client_id == Client.id).filter(
+            association.c.event_id == client.events[0].id, Client.discord_user_id == client.discord_user_id
+        ),
+        'discord user': DiscordUser.query.filter_by(user_id=client.discorduser.user_id),
+        'guild clients': Client.query.join(
+            DiscordUser, DiscordUser.global_client_id == Client.id
+        ).join(
+            GuildMember, GuildMember.discord_user_id == DiscordUser.id
+        ).filter(GuildMember.guild_id == 0)
+    }
+
+
+def find_seq_scans(plan: dict):
+    if plan.get('Node Type') == 'Seq Scan' and plan.get('Relation Name') in _CHECKED_TABLES:
+        yield plan['Relation Name']
+    for child in plan.get('Plans', []):
+        yield from find_seq_scans(child)
+
+
+def explain(query) -> dict:
+    connection = db.session.connection()
+    statement = getattr(query, 'statement', query)
+    compiled = statement.compile(dialect=connection.dialect)
+    result = connection.exec_driver_sql(f'EXPLAIN (FORMAT JSON) {compiled}', compiled.params).scalar()
+    if isinstance(result, str):
+        result = json.loads(result)
+    return result[0]['Plan']
+
+
+def run() -> bool:
+    if db.engine.dialect.name != 'postgresql':
+        print(f'Query plans can only be checked on PostgreSQL, got {db.engine.dialect.name}')
+        return False
+
+    if not Client.query.filter_by(name=_NAME).first():
+        print(f'Seeding {args.clients} clients with {args.balances} balances each')
+        seed()
+    with db.engine.connect() as connection:
+        connection.exec_driver_sql('ANALYZE')
+
+    client = Client.query.filter_by(name=_NAME).order_by(Client.id).offset(args.clients // 2).first()
+
+    success = True
+    for name, query in hot_queries(client).items():
+        plan = explain(query)
+        seq_scans = list(find_seq_scans(plan))
+        if seq_scans:
+            success = False
+            print(f'FAIL {name}: sequential scan on {", ".join(seq_scans)}')
+        else:
+            print(f'OK   {name}')
+        if args.verbose or seq_scans:
+            print(json.dumps(plan, indent=2))
+    return success
+
+
+if __name__ == '__main__':
+    try:
+        result = run()
+    finally:
+        db.session.rollback()
+        if not args.keep:
+            remove()
+    sys.exit(0 if result else 1)
@@ -0,0 +1,83 @@
+from __future__ import annotations
+import asyncio
+import logging
+import time
+from typing import Optional
+
+
+class TokenBucket:
+    """
+    Asynchronous token bucket used to throttle requests to a single exchange host.
+
+    The bucket holds up to `capacity` tokens (request weight) and refills them continuously over `interval` seconds,
+    so bursts up to the full capacity go through immediately and everything above is paced to the refill rate.
+    Exchanges which report their used weight can sync the bucket with the server side counter via `update_used`.
+    """
+
+    def __init__(self, capacity: float, interval: float, name: str = ''):
+        self.capacity = capacity
+        self.interval = interval
+        self.name = name
+
+        self._tokens = float(capacity)
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._lock: Optional[asyncio.Lock] = None
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / self.interval
+
+    @property
+    def available(self) -> float:
+        self._refill()
+        return self._tokens
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    async def acquire(self, weight: float = 1):
+        """
+        Waits until `weight` tokens are available and consumes them.
+        Waiters are served in FIFO order so a heavy request can't be starved by lighter ones.
+        """
+        weight = min(weight, self.capacity)
+        # Created lazily so the lock is bound to the running loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill()
+                if self._tokens >= weight:
+                    self._tokens -= weight
+                    return
+                await asyncio.sleep((weight - self._tokens) / self.rate)
+
+    def update_used(self, used: float, capacity: float = None):
+        """
+        Syncs the bucket with the weight the exchange reports as used in the current window.
+        Only ever lowers the available tokens, since the server side window might reset before ours does.
+        :param used: Used weight reported by the exchange
+        :param capacity: Optional capacity reported by the exchange
+        """
+        if capacity:
+            self.capacity = capacity
+        self._refill()
+        self._tokens = min(self._tokens, max(self.capacity - used, 0))
+
+    def pause(self, seconds: float):
+        """
+        Blocks the bucket completely, e.g. after the exchange answered with 429 and a Retry-After header.
+        """
+        self._tokens = 0
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        logging.warning(f'Rate limit for {self.name} exceeded, pausing requests for {seconds} seconds')
+
+    def __repr__(self):
+        return f'<TokenBucket name={self.name} capacity={self.capacity} interval={self.interval} tokens={round(self._tokens, 2)}>'
@@ -4,19 +4,32 @@ import asyncio
 import aiohttp
 import logging
 import math
+import multiprocessing
+import queue
+import time as perf
+import zlib
+from collections import deque, Counter
 from datetime import datetime, timedelta
 from threading import RLock, Timer
-from typing import List, Dict, Callable, Optional, Any
+from typing import List, Dict, Callable, Optional, Any, Deque, Iterable, Tuple
+
+from sqlalchemy import inspect
+from sqlalchemy.ext.asyncio import AsyncSession
 
 import api.dbutils as dbutils
-from api.database import db
-from api.dbmodels.balance import Balance
+from api.database import db, async_session
+from api.dbmodels.balance import Balance, expand_runs
+from api.dbmodels.balancerollup import RESOLUTIONS, get_bucket
 from api.dbmodels.client import Client
 from api.dbmodels.discorduser import DiscordUser
 import api.dbmodels.event as db_event
 from exchangeworker import ExchangeWorker
+from priceindex import PriceIndex
 from config import CURRENCY_ALIASES
+from models.connectionpool import ConnectionPoolConfig, ConnectionPoolStats
 from models.history import History
+from models.cyclestats import CycleStats
+from models.recentbalance import RecentBalance
 from models.singleton import Singleton
 
 
@@ -27,34 +40,110 @@ class UserManager(Singleton):
              fetching_interval_hours: int = 4,
              rekt_threshold: float = 2.5,
              data_path: str = '',
-             on_rekt_callback: Callable[[DiscordUser], Any] = None):
+             on_rekt_callback: Callable[[DiscordUser], Any] = None,
+             spread_fetching: bool = False,
+             spread_resolution_seconds: float = 1.0,
+             streaming: bool = False,
+             stream_persist_seconds: float = 300,
+             connection_pool: ConnectionPoolConfig = None,
+             fetching_processes: int = 1,
+             compress_balances: bool = False,
+             retention_days: int = None,
+             compaction_resolution: str = 'hour',
+             compaction_batch_size: int = 1000):
+
+        # Every setting, so that fetching processes are configured exactly like this instance
+        self._options = {key: value for key, value in locals().items() if key not in ('self', 'on_rekt_callback')}
 
         # Public parameters
         self.interval_hours = fetching_interval_hours
+        self.spread_fetching = spread_fetching
+        self.spread_resolution_seconds = spread_resolution_seconds
+        self.streaming = streaming
+        self.stream_persist_seconds = stream_persist_seconds
         self.rekt_threshold = rekt_threshold
         self.data_path = data_path
         self.backup_path = self.data_path + 'backup/'
         self.on_rekt_callback = on_rekt_callback
+        self.fetching_processes = fetching_processes
+        # Store unchanged balances as runs (first and last fetch) instead of moving the latest balance
+        self.compress_balances = compress_balances
+        # Balances older than retention_days are compacted to one balance per compaction_resolution
+        self.retention_days = retention_days
+        self.compaction_resolution = compaction_resolution
+        self.compaction_batch_size = compaction_batch_size
 
         self._exchanges = exchanges
+        # (index, count) if this instance only fetches a shard of all clients inside a worker process
+        self._shard: Optional[Tuple[int, int]] = None
+        self._shard_processes: List[multiprocessing.Process] = []
         self._workers: List[ExchangeWorker] = []
         self._workers_by_client_id: Dict[int, ExchangeWorker] = {}
+        # Tail of the latest stored balances per client, used to detect unchanged balances without loading the history
+        self._recent_balances: Dict[int, Deque[RecentBalance]] = {}
+        # Timings of the latest fetch cycle
+        self.last_cycle_stats: Optional[CycleStats] = None
+
+        self.connection_pool = connection_pool or ConnectionPoolConfig()
+        self._session: Optional[aiohttp.ClientSession] = None
 
-        self.session = aiohttp.ClientSession()
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """
+        Shared http session of all workers. It is created on first use so that it belongs to the running event loop
+        (the instance itself may be created at import time, before the loop exists).
+        """
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.connection_pool.limit,
+                    limit_per_host=self.connection_pool.limit_per_host,
+                    keepalive_timeout=self.connection_pool.keepalive_timeout,
+                    use_dns_cache=True,
+                    ttl_dns_cache=self.connection_pool.dns_cache_ttl
+                ),
+                timeout=aiohttp.ClientTimeout(total=self.connection_pool.total_timeout)
+            )
+        return self._session
+
+    def get_connection_pool_stats(self) -> Dict[str, ConnectionPoolStats]:
+        """
+        Open, idle and waiting connections per host of the shared session.
+        aiohttp doesn't expose these publicly, so the connector internals are read defensively.
+        """
+        connector = self.session.connector
+        acquired = Counter()
+        idle = Counter()
+        waiting = Counter()
+        for key, protocols in getattr(connector, '_acquired_per_host', {}).items():
+            acquired[key.host] += len(protocols)
+        for key, connections in getattr(connector, '_conns', {}).items():
+            idle[key.host] += len(connections)
+        for key, waiters in getattr(connector, '_waiters', {}).items():
+            waiting[key.host] += len(waiters)
+        return {
+            host: ConnectionPoolStats(open=acquired[host] + idle[host], idle=idle[host], waiting=waiting[host])
+            for host in set(acquired) | set(idle) | set(waiting)
+        }
 
     def _add_worker(self, worker: ExchangeWorker):
         if worker not in self._workers:
             self._workers.append(worker)
-            self._workers_by_client_id[worker.client.id] = worker
+            self._workers_by_client_id[worker.client_id] = worker
+            # With fetching processes each shard streams its own clients
+            if self.streaming and not self.is_coordinator:
+                worker.connect()
 
     def _remove_worker(self, worker: ExchangeWorker):
         if worker in self._workers:
-            self._workers_by_client_id.pop(worker.client.id, None)
+            self._workers_by_client_id.pop(worker.client_id, None)
             self._workers.remove(worker)
+            worker.disconnect()
             del worker
 
     def delete_client(self, client: Client, commit=True):
         self._remove_worker(self._get_worker(client, create_if_missing=False))
+        self._recent_balances.pop(client.id, None)
         Client.query.filter_by(id=client.id).delete()
         if commit:
             db.session.commit()
@@ -63,13 +152,175 @@ class UserManager(Singleton):
         """
         Start fetching data at specified interval
         """
+        if self.streaming and not self.is_coordinator:
+            asyncio.create_task(self._persist_live_balances())
+        if self.retention_days and not self._shard:
+            asyncio.create_task(self._enforce_retention())
+        if self.is_coordinator:
+            return await self._start_fetching_sharded()
+        if self._shard:
+            self.synch_workers()
+        if self.spread_fetching:
+            return await self._start_fetching_spread()
         while True:
             await self._async_fetch_data()
             time = datetime.now()
-            next = time.replace(hour=(time.hour - time.hour % self.interval_hours), minute=0, second=0,
-                                microsecond=0) + timedelta(hours=self.interval_hours)
-            delay = next - time
+            delay = self._get_interval_start(time) + timedelta(hours=self.interval_hours) - time
             await asyncio.sleep(delay.total_seconds())
+            if self._shard:
+                # Pick up clients which were registered in the meantime
+                self.synch_workers()
+
+    async def _start_fetching_spread(self):
+        """
+        Instead of fetching every client at the interval boundary, each client is fetched at its own stable slot
+        inside the interval. Slots which are due are fetched together in batches every spread_resolution_seconds.
+        """
+        interval = timedelta(hours=self.interval_hours)
+        interval_start = self._get_interval_start(datetime.now())
+        # Slots which already passed in the current interval are fetched in the next one
+        last_offset = (datetime.now() - interval_start).total_seconds()
+
+        while True:
+            offset = (datetime.now() - interval_start).total_seconds()
+
+            if offset >= interval.total_seconds():
+                workers = self._get_due_workers(last_offset, interval.total_seconds())
+                interval_start += interval
+                last_offset = 0.0
+                if self._shard:
+                    self.synch_workers()
+            else:
+                workers = self._get_due_workers(last_offset, offset)
+                last_offset = offset
+
+            if workers:
+                await self._async_fetch_data(workers)
+
+            offset = (datetime.now() - interval_start).total_seconds()
+            slots = [
+                slot for slot in (self._get_fetch_slot(worker.client_id) for worker in self._workers)
+                if slot >= last_offset
+            ]
+            next_slot = min(slots, default=interval.total_seconds())
+            await asyncio.sleep(max(next_slot - offset, self.spread_resolution_seconds))
+
+    @property
+    def is_coordinator(self) -> bool:
+        """
+        Whether the fetching is delegated to worker processes
+        """
+        return self.fetching_processes > 1 and self._shard is None
+
+    async def _start_fetching_sharded(self):
+        """
+        Spawns one process per shard. Each process fetches the clients with client.id % fetching_processes == index
+        with its own event loop, http session and database connection and writes the results straight into the database.
+        The coordinator only restarts crashed processes and forwards rekt clients to on_rekt_callback.
+        Streaming is left to the processes as well, so every client has a single stream.
+        """
+        context = multiprocessing.get_context('spawn')
+        rekt_queue = context.Queue()
+        options = self._options
+
+        def start_process(index: int) -> multiprocessing.Process:
+            process = context.Process(
+                target=_run_fetch_shard,
+                args=(index, self.fetching_processes, options, rekt_queue),
+                name=f'fetch-shard-{index}',
+                daemon=True
+            )
+            process.start()
+            return process
+
+        self._shard_processes = [start_process(index) for index in range(self.fetching_processes)]
+        logging.info(f'Started {self.fetching_processes} fetching processes')
+
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                client_id = await loop.run_in_executor(None, rekt_queue.get, True, 60)
+                # rekt_on was written by the fetching process
+                client = Client.query.filter_by(id=client_id).populate_existing().first()
+                if client:
+                    worker = self._workers_by_client_id.get(client_id)
+                    if worker:
+                        worker.rekt_on = client.rekt_on
+                    if callable(self.on_rekt_callback):
+                        self.on_rekt_callback(client)
+            except queue.Empty:
+                pass
+            for index, process in enumerate(self._shard_processes):
+                if not process.is_alive():
+                    logging.error(f'Fetching process {process.name} died with exit code {process.exitcode}, restarting')
+                    self._shard_processes[index] = start_process(index)
+
+    async def _persist_live_balances(self):
+        """
+        Stores the live balances of all streaming workers every stream_persist_seconds.
+        """
+        while True:
+            await asyncio.sleep(self.stream_persist_seconds)
+            workers = [worker for worker in self._workers if worker.is_streaming]
+            if workers:
+                # The stream keeps the live balances up to date, the regular fetching refreshes stale ones over REST
+                await self._async_fetch_data(workers, live_only=True)
+
+    async def _enforce_retention(self):
+        """
+        Compacts the balances which are older than retention_days once a day.
+        """
+        bucket = RESOLUTIONS[self.compaction_resolution]
+        while True:
+            cutoff = datetime.now() - timedelta(days=self.retention_days)
+            start = perf.perf_counter()
+            deleted = 0
+            async with async_session() as session:
+                client_ids = (await session.execute(db.select(Client.id))).scalars().all()
+                for client_id in client_ids:
+                    deleted += await self._compact_balances(session, client_id, cutoff, bucket)
+            logging.info(f'Compacted {deleted} balances older than {cutoff} '
+                         f'in {round(perf.perf_counter() - start, ndigits=3)}s')
+            await asyncio.sleep(timedelta(days=1).total_seconds())
+
+    async def _compact_balances(self, session: AsyncSession, client_id: int, cutoff: datetime, bucket: timedelta) -> int:
+        """
+        Deletes all balances of a client before the cutoff except the latest one of each bucket,
+        in batches of compaction_batch_size. The first balance and the balances used at event boundaries
+        are always kept, so that event results and archives stay reproducible.
+        :return: Number of deleted balances
+        """
+        keep = await dbutils.async_get_retained_balance_ids(session, client_id)
+
+        deleted = 0
+        while True:
+            balance_ids = await dbutils.async_get_compactable_balance_ids(
+                session, client_id, cutoff, bucket, keep=keep, limit=self.compaction_batch_size
+            )
+            if not balance_ids:
+                return deleted
+            await session.execute(
+                db.delete(Balance).where(Balance.id.in_(balance_ids)).execution_options(synchronize_session=False)
+            )
+            await session.commit()
+            deleted += len(balance_ids)
+            # Give other tasks a turn between batches
+            await asyncio.sleep(0)
+
+    def _get_interval_start(self, time: datetime) -> datetime:
+        return time.replace(hour=(time.hour - time.hour % self.interval_hours), minute=0, second=0, microsecond=0)
+
+    def _get_fetch_slot(self, client_id: int) -> float:
+        """
+        Stable offset in seconds of the given client inside the fetching interval
+        """
+        interval_seconds = self.interval_hours * 60 * 60
+        return zlib.crc32(str(client_id).encode()) / 2**32 * interval_seconds
+
+    def _get_due_workers(self, start: float, end: float) -> List[ExchangeWorker]:
+        return [
+            worker for worker in self._workers if start <= self._get_fetch_slot(worker.client_id) < end
+        ]
 
     async def fetch_data(self, clients: List[Client] = None, guild_id: int = None):
         workers = [self._get_worker(client) for client in clients]
@@ -80,7 +331,13 @@ class UserManager(Singleton):
         if currency is None:
             currency = '$'
 
-        data = await self._async_fetch_data(workers=[self._get_worker(client)], keep_errors=True, force_fetch=force_fetch)
+        worker = self._get_worker(client)
+        live = worker.get_live_balance() if worker and worker.is_streaming and not force_fetch else None
+        if live:
+            # Streaming workers can answer instantly, the balance gets persisted with the next cycle
+            data = [live]
+        else:
+            data = await self._async_fetch_data(workers=[worker], keep_errors=True, force_fetch=force_fetch)
 
         if data:
             result = data[0]
@@ -97,18 +354,41 @@ class UserManager(Singleton):
         return result
 
     def synch_workers(self):
-        clients = Client.query.all()
+        query = Client.query
+        if self._shard:
+            index, count = self._shard
+            query = query.filter(Client.id % count == index)
+        clients = query.all()
+        self._load_secrets([
+            client for client in clients
+            if client.id not in self._workers_by_client_id and (client.is_global or client.is_active)
+        ])
 
         for client in clients:
             if client.is_global or client.is_active:
-                self.add_client(client)
+                worker = self._get_worker(client)
+                if worker:
+                    worker.rekt_on = client.rekt_on
             else:
                 self._remove_worker(self._get_worker(client, create_if_missing=False))
 
+    def _load_secrets(self, clients: List[Client]):
+        """
+        Loads (and decrypts) the deferred api secrets of the given clients with a single query.
+        The decrypted secret is only held by the worker built from the client and is gone once the worker is removed.
+        """
+        if clients:
+            Client.query.options(
+                db.load_only(Client.id), db.undefer(Client.api_secret)
+            ).filter(Client.id.in_([client.id for client in clients])).all()
+
     def add_client(self, client) -> ExchangeWorker:
         client_cls = self._exchanges[client.exchange]
         if issubclass(client_cls, ExchangeWorker):
             worker = client_cls(client, self.session)
+            # The worker keeps its own copy, the decrypted secret shouldn't stay around in the session as well
+            if inspect(client).persistent:
+                db.session.expire(client, ['api_secret'])
             self._add_worker(worker)
             return worker
         else:
@@ -131,15 +411,15 @@ class UserManager(Singleton):
                            event: db_event.Event,
                            since: datetime = None,
                            to: datetime = None,
-                           currency: str = None) -> History:
-
-        since = since or datetime.fromtimestamp(0)
-        to = to or datetime.now()
-
-        if event:
-            # When custom times are given make sure they don't exceed event boundaries (clients which are global might have more data)
-            since = max(since, event.start)
-            to = min(to, event.end)
+                           currency: str = None,
+                           limit: int = None,
+                           bucket: timedelta = None) -> History:
+        """
+        Loads the history of a client inside the given range, the range is limited to the event if one is given.
+        :param limit: Maximum amount of stored balances to load
+        :param bucket: Only load the last balance of each bucket of this size (e.g. for long graphs)
+        """
+        since, to = self._get_history_range(event, since, to)
 
         if currency is None:
             currency = '$'
@@ -147,17 +427,27 @@ class UserManager(Singleton):
         results = []
         initial = None
 
-        if event:
-            for balance in client.history:
+        resolution = self._get_rollup_resolution(bucket) if currency == '$' else None
+        if resolution:
+            # Long ranges are read from the rollups, each bucket is represented by the close of its last rollup
+            rollups = dbutils.get_rollups(client.id, resolution, since, to, bucket=bucket)
+            first = dbutils.get_first_balance(client.id, since, to)
+            # Rollups which don't reach back to the first balance (e.g. not backfilled yet) would cut off the history
+            if rollups and first and rollups[0].bucket <= get_bucket(first.time, resolution):
+                size = RESOLUTIONS[resolution]
+                results = [
+                    Balance(client_id=client.id, time=min(rollup.bucket + size, to), amount=rollup.close, currency='$')
+                    for rollup in rollups
+                ]
+
+        if not results:
+            balances = dbutils.get_balances(client.id, since, to, limit=limit, bucket=bucket, currency=currency)
+            for balance in expand_runs(balances):
                 if since <= balance.time <= to:
-                    if currency != '$':
-                        balance = self.db_match_balance_currency(balance, currency)
-                    if balance:
-                        results.append(balance)
-                elif event.start <= balance.time and not initial:
-                    initial = balance
-        else:
-            results = client.history
+                    results.append(balance)
+
+        if event:
+            initial = dbutils.get_first_balance(client.id, since=event.start, to=event.end)
 
         if not initial:
             try:
@@ -170,6 +460,45 @@ class UserManager(Singleton):
             initial=initial
         )
 
+    @staticmethod
+    def _get_rollup_resolution(bucket: Optional[timedelta]) -> Optional[str]:
+        """
+        :return: The coarsest rollup resolution which evenly divides the bucket, if any
+        """
+        if bucket:
+            for resolution, size in sorted(RESOLUTIONS.items(), key=lambda item: item[1], reverse=True):
+                if bucket >= size and bucket % size == timedelta(0):
+                    return resolution
+
+    def get_client_first_latest(self,
+                                client: Client,
+                                event: db_event.Event,
+                                since: datetime = None,
+                                to: datetime = None,
+                                currency: str = None) -> Tuple[Optional[Balance], Optional[Balance]]:
+        """
+        Same range as get_client_history, but only the first and latest balance are loaded.
+        """
+        since, to = self._get_history_range(event, since, to)
+
+        if currency is None:
+            currency = '$'
+
+        return (
+            self.db_match_balance_currency(dbutils.get_first_balance(client.id, since, to), currency),
+            self.db_match_balance_currency(dbutils.get_latest_balance(client.id, since, to), currency)
+        )
+
+    def _get_history_range(self, event: db_event.Event, since: datetime = None, to: datetime = None):
+        since = since or datetime.fromtimestamp(0)
+        to = to or datetime.now()
+
+        if event:
+            # When custom times are given make sure they don't exceed event boundaries (clients which are global might have more data)
+            since = max(since, event.start)
+            to = min(to, event.end)
+        return since, to
+
     def clear_client_data(self,
                           client: Client,
                           start: datetime = None,
@@ -185,70 +514,244 @@ class UserManager(Singleton):
             Balance.time >= start,
             Balance.time <= end
         ).delete()
+        # The buckets at the edges of the range keep the balances outside of it
+        dbutils.rebuild_rollups(client.id, start, end)
+
+        reset = update_initial_balance and not dbutils.get_latest_balance(client.id)
+        if reset:
+            client.rekt_on = None
+            worker = self._get_worker(client, create_if_missing=False)
+            if worker:
+                worker.rekt_on = None
 
         db.session.commit()
+        self._recent_balances.pop(client.id, None)
 
-        if len(client.history) == 0 and update_initial_balance:
-            client.rekt_on = None
+        if reset:
             asyncio.create_task(self.get_client_balance(client, force_fetch=True))
 
     async def _async_fetch_data(self, workers: List[ExchangeWorker] = None,
                                 keep_errors: bool = False,
-                                force_fetch=False) -> List[Balance]:
+                                force_fetch=False,
+                                live_only=False) -> List[Balance]:
         """
+        :param live_only: Only store the live balances of streaming workers, no requests are made
         :return:
         Tuple with timestamp and Dictionary mapping user ids to guild entries with Balance objects (non-errors only)
         """
         time = datetime.now()
+        cycle_start = perf.perf_counter()
 
         if workers is None:
             workers = self._workers
 
         data = []
         tasks = []
+        live_results = []
+        skipped = Counter()
 
         logging.info(f'Fetching data for {len(workers)} workers {keep_errors=}')
         for worker in workers:
             if not worker:
                 continue
+            if live_only:
+                live = worker.get_live_balance(time, any_age=True)
+                if live:
+                    live_results.append(live)
+                continue
+            if not worker.circuit_breaker.allow():
+                skipped[worker.exchange] += 1
+                if keep_errors:
+                    data.append(
+                        Balance(amount=0.0, currency='$', time=time, extra_currencies={}, client_id=worker.client_id,
+                                error=f'{worker.exchange} is currently unavailable. Try again later.')
+                    )
+                continue
             tasks.append(
                 asyncio.create_task(worker.get_balance(self.session, time, force=force_fetch))
             )
-        results = await asyncio.gather(*tasks)
-
-        for result in results:
-            if isinstance(result, Balance):
-                client = Client.query.filter_by(id=result.client_id).first()
-                if client:
-                    history_len = len(client.history)
-                    latest_balance = None if history_len == 0 else client.history[history_len - 1]
-                    if history_len > 2:
+        for exchange, count in skipped.items():
+            logging.warning(f'Skipped {count} workers, {ExchangeWorker.circuit_breakers[exchange]}')
+        results = await asyncio.gather(*tasks) + live_results
+        results = [result for result in results if isinstance(result, Balance)]
+        fetch_duration = perf.perf_counter() - cycle_start
+
+        client_ids = {result.client_id for result in results}
+        if self.fetching_processes > 1:
+            # The coordinator and the fetching processes both change balances (e.g. /clear in the bot process),
+            # so the cached tails can't be trusted and are reloaded with the cycle
+            for client_id in client_ids:
+                self._recent_balances.pop(client_id, None)
+
+        # Collected for the bulk write stage
+        new_balances: List[Balance] = []
+        unchanged: List[Tuple[int, datetime]] = []
+        extended: List[Tuple[int, datetime]] = []
+        rekt: List[int] = []
+        rollup_points: List[Tuple[int, datetime, float]] = []
+
+        async with async_session() as session:
+            rekt_on_by_id: Dict[int, Optional[datetime]] = {
+                client_id: rekt_on for client_id, rekt_on in await session.execute(
+                    db.select(Client.id, Client.rekt_on).filter(Client.id.in_(client_ids))
+                )
+            } if client_ids else {}
+            await self._load_recent_balances(session, client_ids)
+
+            for result in results:
+                client_id = result.client_id
+                if client_id in rekt_on_by_id:
+                    if not result.error and result.currency == '$':
+                        rollup_points.append((client_id, result.time or time, result.amount))
+                    recent = self._recent_balances[client_id]
+                    if self.compress_balances:
+                        if recent and not result.error \
+                                and math.isclose(recent[-1].amount, result.amount, rel_tol=1e-06):
+                            # The run keeps its first time, only the end is moved
+                            extended.append((client_id, recent[-1].time))
+                            data.append(result)
+                            continue
+                    elif len(recent) > 2:
+                        latest_balance = recent[-1]
                         # If balance hasn't changed at all, why bother keeping it?
                         if math.isclose(latest_balance.amount, result.amount, rel_tol=1e-06) \
-                                and math.isclose(client.history[history_len - 2].amount, result.amount, rel_tol=1e-06):
-                            latest_balance.time = time
-                            data.append(latest_balance)
+                                and math.isclose(recent[-2].amount, result.amount, rel_tol=1e-06):
+                            unchanged.append((client_id, latest_balance.time))
+                            recent[-1] = RecentBalance(time=time, amount=latest_balance.amount)
+                            data.append(result)
                             continue
                     if result.error:
-                        logging.error(f'Error while fetching {client.id=} balance: {result.error}')
+                        logging.error(f'Error while fetching {client_id=} balance: {result.error}')
                         if keep_errors:
                             data.append(result)
 
                     else:
-                        client.history.append(result)
+                        new_balances.append(result)
+                        recent.append(RecentBalance(time=result.time, amount=result.amount))
                         data.append(result)
-                        if result.amount <= self.rekt_threshold and not client.rekt_on:
-                            client.rekt_on = time
-                            if callable(self.on_rekt_callback):
-                                self.on_rekt_callback(client)
+                        if result.amount <= self.rekt_threshold and not rekt_on_by_id[client_id]:
+                            rekt.append(client_id)
                 else:
                     logging.error(f'Worker with {result.client_id=} got no client object!')
 
-        db.session.commit()
+            commit_start = perf.perf_counter()
+            await self._write_balances(session, new_balances, unchanged, extended, rekt, time)
+            await dbutils.async_upsert_rollups(session, sorted(rollup_points, key=lambda point: point[1]))
+            await session.commit()
+        commit_duration = perf.perf_counter() - commit_start
+        logging.info(f'Done Fetching (stored {len(new_balances)} balances, '
+                     f'commit took {round(commit_duration, ndigits=3)}s)')
+        self.last_cycle_stats = CycleStats(
+            time=time,
+            workers=len(workers),
+            fetched=len(results),
+            stored=len(new_balances),
+            duration=perf.perf_counter() - cycle_start,
+            fetch_duration=fetch_duration,
+            commit_duration=commit_duration
+        )
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(f'Price cache: {dict(PriceIndex.cache.stats)}')
+            logging.debug(f'Connection pool: {self.get_connection_pool_stats()}')
+
+        if rekt:
+            for client_id in rekt:
+                worker = self._workers_by_client_id.get(client_id)
+                if worker:
+                    worker.rekt_on = time
+            # rekt_on was written outside of the bot's session, so clients loaded by commands are refreshed
+            rekt_clients = Client.query.filter(Client.id.in_(rekt)).populate_existing().all()
+            if callable(self.on_rekt_callback):
+                for client in rekt_clients:
+                    self.on_rekt_callback(client)
 
-        logging.info(f'Done Fetching')
         return data
 
+    async def _write_balances(self,
+                              session: AsyncSession,
+                              new_balances: List[Balance],
+                              unchanged: List[Tuple[int, datetime]],
+                              extended: List[Tuple[int, datetime]],
+                              rekt: List[int],
+                              time: datetime):
+        """
+        Writes the results of a fetch cycle with a constant number of statements,
+        independent of how many clients were fetched.
+        :param session: Session of the fetch cycle
+        :param new_balances: Balances to insert
+        :param unchanged: (client_id, time) of stored balances which should be moved to the given time
+        :param extended: (client_id, time) of stored runs whose last time should be set to the given time
+        :param rekt: ids of the clients which went rekt during this cycle
+        :param time: Time of the fetch cycle
+        """
+        if new_balances:
+            # asyncpg pipelines the executemany INSERT
+            await session.execute(Balance.__table__.insert(), [
+                {
+                    'client_id': balance.client_id,
+                    'time': balance.time,
+                    'amount': balance.amount,
+                    'currency': balance.currency,
+                    'error': balance.error,
+                    'currencies': balance.extra_currencies
+                }
+                for balance in new_balances
+            ])
+
+        if unchanged:
+            await session.execute(
+                db.update(Balance).where(
+                    db.tuple_(Balance.client_id, Balance.time).in_(unchanged)
+                ).values(time=time).execution_options(synchronize_session=False)
+            )
+
+        if extended:
+            await session.execute(
+                db.update(Balance).where(
+                    db.tuple_(Balance.client_id, Balance.time).in_(extended)
+                ).values(last_time=time).execution_options(synchronize_session=False)
+            )
+
+        if rekt:
+            await session.execute(
+                db.update(Client).where(
+                    Client.id.in_(rekt)
+                ).values(rekt_on=time).execution_options(synchronize_session=False)
+            )
+
+    async def _load_recent_balances(self, session: AsyncSession, client_ids: Iterable[int], size=3):
+        """
+        Loads the latest balances of every client which isn't cached yet with a single query.
+        """
+        missing = [client_id for client_id in client_ids if client_id not in self._recent_balances]
+        if not missing:
+            return
+
+        rank = db.func.row_number().over(
+            partition_by=Balance.client_id,
+            order_by=Balance.time.desc()
+        ).label('rank')
+        latest = db.select(
+            Balance.client_id, Balance.time, Balance.amount, rank
+        ).filter(
+            Balance.client_id.in_(missing)
+        ).subquery()
+
+        for client_id in missing:
+            self._recent_balances[client_id] = deque(maxlen=size)
+
+        rows = await session.execute(
+            db.select(
+                latest.c.client_id, latest.c.time, latest.c.amount
+            ).filter(
+                latest.c.rank <= size
+            ).order_by(
+                latest.c.time
+            )
+        )
+        for client_id, time, amount in rows:
+            self._recent_balances[client_id].append(RecentBalance(time=time, amount=amount))
+
     def db_match_balance_currency(self, balance: Balance, currency: str):
         result = None
 
@@ -272,3 +775,21 @@ class UserManager(Singleton):
             result = balance
 
         return result
+
+
+def _run_fetch_shard(index: int, count: int, options: Dict[str, Any], rekt_queue: multiprocessing.Queue):
+    """
+    Entry point of a fetching process
+    """
+    logging.basicConfig(level=logging.INFO, format=f"%(asctime)s - shard {index} - %(name)s - %(levelname)s - %(message)s")
+
+    # The spawned process re-imports the main module, which may already have created the singleton (with the
+    # callbacks of the coordinator), so the shard's instance replaces it
+    UserManager.__it__ = None
+
+    async def run():
+        user_manager = UserManager(**options, on_rekt_callback=lambda client: rekt_queue.put(client.id))
+        user_manager._shard = (index, count)
+        await user_manager.start_fetching()
+
+    asyncio.run(run())
@@ -1,4 +1,5 @@
 from __future__ import annotations
+import math
 import re
 import logging
 import traceback
@@ -16,6 +17,7 @@ from prettytable import PrettyTable
 
 import api.dbmodels.client as client
 from api import dbutils
+from api.database import db
 from api.dbmodels.client import Client
 from api.dbmodels.discorduser import DiscordUser
 from errors import UserInputError, InternalError
@@ -27,8 +29,12 @@ from usermanager import UserManager
 from datetime import datetime, timedelta
 from discord_slash import SlashContext, SlashCommandOptionType
 from typing import List, Tuple, Callable, Optional, Union, Dict, Any
-from api.dbmodels.balance import Balance
-from config import CURRENCY_PRECISION, REKT_THRESHOLD
+from api.dbmodels.balance import Balance, expand_runs
+from api.dbmodels.balancerollup import get_bucket
+from config import CURRENCY_PRECISION, REKT_THRESHOLD, FETCHING_INTERVAL_HOURS
+
+# Graphs don't need more points than they have pixels, longer ranges are bucketed in the database
+GRAPH_MAX_POINTS = 800
 
 
 def admin_only(coro):
@@ -98,6 +104,8 @@ def log_and_catch_errors(log_args=True, type: str = "command"):
     - UserInputErrors
     - InternalErrors
     - Any other type of exceptions
+    Every command runs in its own session scope: changes are committed once it finished and rolled back on errors,
+    so no transaction (and no loaded objects) stay open between commands.
 
     :param log_args: whether the args passed in should be logged (e.g. disabled when sensitive data is passed).
     :return:
@@ -110,8 +118,10 @@ def log_and_catch_errors(log_args=True, type: str = "command"):
                          f'guild={ctx.guild}{f" {args=}, {kwargs=}" if log_args else ""}')
             try:
                 await coro(ctx, *args, **kwargs)
+                db.session.commit()
                 logging.info(f'Done executing {type} {coro.__name__}')
             except UserInputError as e:
+                db.session.rollback()
                 if e.user_id:
                     if ctx.guild:
                         e.reason = e.reason.replace('{name}', ctx.guild.get_member(e.user_id).display_name)
@@ -121,10 +131,12 @@ def log_and_catch_errors(log_args=True, type: str = "command"):
                 logging.info(
                     f'{type} {coro.__name__} failed because of UserInputError: {de_emojify(e.reason)}\n{traceback.format_exc()}')
             except InternalError as e:
+                db.session.rollback()
                 if ctx.deferred:
                     await ctx.send(f'This is a bug in the bot. Please contact jacksn#9149. ({e.reason})', hidden=True)
                 logging.error(f'{type} {coro.__name__} failed because of InternalError: {e.reason}\n{traceback.format_exc()}')
             except Exception:
+                db.session.rollback()
                 if ctx.deferred:
                     await ctx.send('This is a bug in the bot. Please contact jacksn#9149.', hidden=True)
                 logging.critical(f'{type} {coro.__name__} failed because of an uncaught exception:\n{traceback.format_exc()}')
@@ -191,13 +203,20 @@ async def create_history(to_graph: List[Tuple[Client, str]],
 
     um = UserManager()
     await um.fetch_data([graph[0] for graph in to_graph])
+    graph_start = start or (event.start if event else None)
+    if not graph_start:
+        # Without a start the graph covers the whole history, which begins with the earliest first balance
+        firsts = [um.get_client_first_latest(registered_client, event, to=end)[0] for registered_client, _ in to_graph]
+        graph_start = min((first.time for first in firsts if first), default=None)
+    bucket = get_graph_bucket(graph_start, end)
     for registered_client, name in to_graph:
 
         history = um.get_client_history(registered_client,
                                         event=event,
                                         since=start,
                                         to=end,
-                                        currency=currency)
+                                        currency=currency,
+                                        bucket=bucket)
 
         if len(history.data) == 0:
             if throw_exceptions:
@@ -230,6 +249,18 @@ async def create_history(to_graph: List[Tuple[Client, str]],
     plt.close()
 
 
+def get_graph_bucket(start: datetime, end: datetime = None) -> Optional[timedelta]:
+    """
+    :return: Bucket size which keeps the graph below GRAPH_MAX_POINTS or None if the range is short enough
+    """
+    if start:
+        bucket = ((end or datetime.now()) - start) / GRAPH_MAX_POINTS
+        if bucket > timedelta(hours=FETCHING_INTERVAL_HOURS):
+            # Whole hours, so that long graphs can be read from the hourly rollups
+            return timedelta(hours=math.ceil(bucket / timedelta(hours=1)))
+    return None
+
+
 def get_best_time_fit(search: datetime, prev: Balance, after: Balance):
     if abs((prev.time - search).total_seconds()) < abs((after.time - search).total_seconds()):
         return prev
@@ -257,7 +288,8 @@ def calc_daily(client: Client,
     :param string: Whether the created table should be stored as a string using prettytable or as an array containing each row as a Tuple of the Cols
     :return:
     """
-    if len(client.history) == 0:
+    first_balance = dbutils.get_first_balance(client.id)
+    if not first_balance:
         if throw_exceptions:
             raise UserInputError(reason='Got no data for this user')
         else:
@@ -282,7 +314,7 @@ def calc_daily(client: Client,
         except OverflowError:
             raise ValueError('Invalid daily amount given')
     else:
-        daily_start = client.history[0].time
+        daily_start = first_balance.time
 
     daily_start = max(since, daily_start).replace(hour=0, minute=0, second=0)
 
@@ -295,9 +327,10 @@ def calc_daily(client: Client,
 
     current_day = daily_start
     current_search = daily_start + timedelta(days=1)
-    prev_balance = um.db_match_balance_currency(client.history[0], currency)
-    prev_daily = client.history[0]
-    prev_daily.time = prev_daily.time.replace(hour=0, minute=0, second=0)
+    prev_balance = um.db_match_balance_currency(
+        dbutils.get_latest_balance(client.id, to=daily_start) or first_balance, currency
+    )
+    prev_daily = first_balance
 
     if string:
         results = PrettyTable(
@@ -305,12 +338,33 @@ def calc_daily(client: Client,
         )
     else:
         results = []
-    for balance in client.history:
+
+    if currency == '$' and not callable(forEach):
+        # Daily closes are already aggregated, only clients without rollups need to walk the raw balances
+        rollups = dbutils.get_rollups(client.id, 'day', since=max(since, daily_start), to=daily_end)
+        first_daily = dbutils.get_first_balance(client.id, since=max(since, daily_start), to=daily_end)
+        # Rollups which don't reach back to the first balance (e.g. not backfilled yet) would drop the earlier days
+        if rollups and first_daily and rollups[0].bucket <= get_bucket(first_daily.time, 'day'):
+            prev_amount = prev_daily.amount
+            for rollup in rollups:
+                values = (
+                    rollup.bucket.strftime('%Y-%m-%d'),
+                    rollup.close,
+                    round(rollup.close - prev_amount, ndigits=CURRENCY_PRECISION.get(currency, 2)),
+                    calc_percentage(prev_amount, rollup.close, string=False)
+                )
+                if string:
+                    results.add_row([*values])
+                else:
+                    results.append(values)
+                prev_amount = rollup.close
+            return results
+
+    for balance in expand_runs(dbutils.get_balances(client.id, since=max(since, daily_start), to=to)):
         if since <= balance.time <= to:
             if balance.time >= current_search:
 
                 daily = um.db_match_balance_currency(get_best_time_fit(current_search, prev_balance, balance), currency)
-                daily.time = daily.time.replace(minute=0, second=0)
 
                 prev_daily = prev_daily or daily
                 values = (
@@ -381,24 +435,20 @@ async def create_leaderboard(dc_client: discord.Client,
     if event:
         clients = event.registrations
     else:
-        clients = []
-        # All global clients
-        users = DiscordUser.query.filter(DiscordUser.global_client_id is not None).all()
-        for user in users:
-            member = guild.get_member(user.user_id)
-            if member:
-                clients.append(user.global_client)
+        # Global clients of the guild's members
+        clients = dbutils.get_guild_clients(guild_id)
 
     if not archived:
         user_manager = UserManager()
         await user_manager.fetch_data(clients=clients)
 
     if mode == 'balance':
+        latest = dbutils.get_latest_balances(client.id for client in clients if not client.rekt_on)
         for client in clients:
+            balance = latest.get(client.id)
             if client.rekt_on:
                 users_rekt.append(client)
-            elif len(client.history) > 0:
-                balance = client.history[len(client.history) - 1]
+            elif balance:
                 if balance.amount > REKT_THRESHOLD:
                     user_scores.append((client, balance.amount))
                     value_strings[client] = balance.to_string(display_extras=False)
@@ -513,11 +563,9 @@ def calc_gains(clients: List[Client],
         #    currency
         #)
 
-        history = user_manager.get_client_history(client, event, since=search, currency=currency)
+        balance_then, balance_now = user_manager.get_client_first_latest(client, event, since=search, currency=currency)
 
-        if history.data:
-            balance_then = history.data[0]
-            balance_now = user_manager.db_match_balance_currency(history.data[len(history.data) - 1], currency)
+        if balance_then and balance_now:
             diff = round(balance_now.amount - balance_then.amount,
                          ndigits=CURRENCY_PRECISION.get(currency, 3))
 